@@ -1,40 +1,134 @@
-import sys
+import math
+from collections import namedtuple
 from collections.abc import Iterable
 
+from parallel_marshall.shared_references import find_shared_objects
+from parallel_marshall.size_estimators import deep_size
+
+# Values are only split into chunks of at least this size
+min_chunk_size = 1024 * 1024
+
+# Key of a chunk of a value split between bins, index is its position
+ChunkKey = namedtuple("ChunkKey", ["key", "index", "count"])
+
+
+def is_splittable(value):
+    """
+    Values which can be split into chunks by slicing and joined again.
+    Subclasses are excluded, slicing them gives the base type.
+    """
+    value_type = type(value)
+    if value_type.__module__ == "numpy" and value_type.__name__ == "ndarray":
+        return value.ndim > 0
+    return value_type in (list, tuple, bytes, bytearray)
+
+
+def split_value(value, index, count):
+    """
+    Chunk of the value at the index when split into count chunks.
+    """
+    start = len(value) * index // count
+    stop = len(value) * (index + 1) // count
+    return value[start:stop]
+
+
+def join_chunks(chunks):
+    """
+    Reassemble a value from its chunks ordered by their index.
+    """
+    first = chunks[0]
+    if type(first) in (bytes, bytearray):
+        return type(first)().join(chunks)
+    elif type(first) in (list, tuple):
+        return type(first)(item for chunk in chunks for item in chunk)
+    import numpy
+
+    return numpy.concatenate(chunks)
+
 
 class BalancedDistributionIterator(Iterable):
-    def __init__(self, obj, n_bins):
+    """
+    Distribute items of a dict or a list between n_bins bins of similar
+    size. Values larger than a fair share of a bin are split into chunks,
+    so that a single huge value is processed by several workers. Every bin
+    is a dict mapping keys (indices of a list) or ChunkKeys to the values.
+    With keep_identity, values reachable from other items aren't split,
+    joining the chunks would create a copy of them.
+    """
+
+    def __init__(
+        self, obj, n_bins, size_estimator=deep_size, keep_identity=False
+    ):
         self.obj = obj
         self.n_bins = n_bins
+        self.size_estimator = size_estimator
+        self.keep_identity = keep_identity
         self.bins, self.keys_or_indices = self._balanced_distribution(obj)
         self.current_bin = 0
 
     def _balanced_distribution(self, obj):
         if isinstance(obj, dict):
-            size_items = sorted(
-                (sys.getsizeof(value), key) for key, value in obj.items()
-            )
-            bins = [set() for _ in range(self.n_bins)]
+            items = obj.items()
         elif isinstance(obj, list):
-            size_items = sorted(
-                (sys.getsizeof(value), index)
-                for index, value in enumerate(obj)
-            )
-            bins = [[] for _ in range(self.n_bins)]
+            items = enumerate(obj)
         else:
             raise TypeError("Object must be a dictionary or a list")
 
+        size_items = [
+            (self.size_estimator(value), key, value) for key, value in items
+        ]
+        fair_share = sum(size for size, _, _ in size_items) / self.n_bins
+        shared_ids = self._shared_ids(size_items, fair_share)
+        split_size_items = []
+        for size, key, value in size_items:
+            count = 1
+            if (
+                size > fair_share
+                and is_splittable(value)
+                and shared_ids is not None
+                and id(value) not in shared_ids
+            ):
+                count = min(
+                    math.ceil(size / fair_share),
+                    size // min_chunk_size,
+                    len(value),
+                    self.n_bins,
+                )
+            if count > 1:
+                split_size_items.extend(
+                    (size / count, ChunkKey(key, index, count))
+                    for index in range(count)
+                )
+            else:
+                split_size_items.append((size, key))
+        split_size_items.sort(key=lambda size_item: size_item[0])
+
+        bins = [[] for _ in range(self.n_bins)]
         sizes = [0] * self.n_bins
-        for size, key_or_index in reversed(size_items):
+        for size, key_or_index in reversed(split_size_items):
             min_index = sizes.index(min(sizes))
-            (
-                bins[min_index].add(key_or_index)
-                if isinstance(obj, dict)
-                else bins[min_index].append(key_or_index)
-            )
+            bins[min_index].append(key_or_index)
             sizes[min_index] += size
 
-        return bins, [item for _, item in size_items]
+        return bins, [item for _, item in split_size_items]
+
+    def _shared_ids(self, size_items, fair_share):
+        """
+        Identities of the values reachable from more than one item, None if
+        they can't be determined and nothing may be split. Only analyzed if
+        there is a value to split.
+        """
+        if not self.keep_identity or not any(
+            size > fair_share and is_splittable(value)
+            for size, _, value in size_items
+        ):
+            return set()
+        shared_objects = find_shared_objects(
+            [{key: value} for _, key, value in size_items]
+        )
+        if shared_objects is None:
+            return None
+        return {id(obj) for obj in shared_objects}
 
     def __iter__(self):
         return self
@@ -43,11 +137,36 @@ class BalancedDistributionIterator(Iterable):
         if self.current_bin >= self.n_bins:
             raise StopIteration
 
-        if isinstance(self.obj, dict):
-            subdict = {k: self.obj[k] for k in self.bins[self.current_bin]}
-            self.current_bin += 1
-            return subdict
-        elif isinstance(self.obj, list):
-            sublist = [self.obj[i] for i in self.bins[self.current_bin]]
-            self.current_bin += 1
-            return sublist
+        subobj = {}
+        for key in self.bins[self.current_bin]:
+            if isinstance(key, ChunkKey):
+                subobj[key] = split_value(
+                    self.obj[key.key], key.index, key.count
+                )
+            else:
+                subobj[key] = self.obj[key]
+        self.current_bin += 1
+        return subobj
+
+
+def merge_bins(subobjs, is_list=False):
+    """
+    Merge bins created by BalancedDistributionIterator into the original
+    dict or list, joining chunks of split values in order.
+    """
+    items = {}
+    chunks = {}
+    for subobj in subobjs:
+        for key, value in subobj.items():
+            if isinstance(key, ChunkKey):
+                chunks.setdefault(key.key, [None] * key.count)[
+                    key.index
+                ] = value
+            else:
+                items[key] = value
+    for key, value_chunks in chunks.items():
+        items[key] = join_chunks(value_chunks)
+
+    if is_list:
+        return [items[index] for index in range(len(items))]
+    return items
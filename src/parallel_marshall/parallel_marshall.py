@@ -1,11 +1,25 @@
+import atexit
+import concurrent.futures
 import os
 import stat
 import multiprocessing
+import uuid
 from parallel_marshall.balanced_distribution_iterator import (
     BalancedDistributionIterator,
+    merge_bins,
 )
+from parallel_marshall.shared_references import find_shared_objects
+from parallel_marshall.size_estimators import (
+    deep_size,
+    serialized_size,
+    shallow_size,
+)
+import functools
 import importlib
 import logging
+import math
+import pickle
+import time
 
 # mode is automatically determined by the file object that is passed for
 # dumping
@@ -22,6 +36,27 @@ if os.environ.get("SCOREP_JUPYTER_PARALLEL_MARSHALL_NWORKERS"):
 else:
     workers = multiprocessing.cpu_count()
 debug = int(os.environ.get("SCOREP_JUPYTER_PARALLEL_MARSHALL_DEBUG", 20))
+# how sizes of variables are estimated to balance them between workers
+size_estimator_name = str(
+    os.environ.get("SCOREP_JUPYTER_PARALLEL_MARSHALL_SIZE_ESTIMATOR", "deep")
+)
+# adapt number of parts to the payload, workers is the upper bound then
+adaptive = int(os.environ.get("SCOREP_JUPYTER_PARALLEL_MARSHALL_ADAPTIVE", 1))
+# time a worker should be busy at least to pay off its start
+min_worker_time = float(
+    os.environ.get("SCOREP_JUPYTER_PARALLEL_MARSHALL_MIN_WORKER_TIME", 0.1)
+)
+# assumed bytes per second of a worker until dumps have been measured
+default_worker_throughput = 100 * 1024 * 1024
+# serialize objects referenced from several parts once, keeping identity
+share_references = int(
+    os.environ.get("SCOREP_JUPYTER_PARALLEL_MARSHALL_SHARE_REFERENCES", 1)
+)
+# writers of the parts, forked "process"es or "thread"s of the dumping
+# process (no fork of a huge process, relies on buffer writes releasing GIL)
+writer_backend = str(
+    os.environ.get("SCOREP_JUPYTER_PARALLEL_MARSHALL_WRITER", "process")
+)
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(filename="parallel_marshall.log", level=logging.INFO)
@@ -37,81 +72,342 @@ except ModuleNotFoundError:
     logger.error("Backend marshalling module not found. Exit.")
     exit(1)
 
+if size_estimator_name == "shallow":
+    size_estimator = shallow_size
+elif size_estimator_name == "serialized":
+    size_estimator = functools.partial(
+        serialized_size, serializer=serializer_backend
+    )
+else:
+    size_estimator = deep_size
+
+
+class BufferPickler(serializer_backend.Pickler):
+    def reducer_override(self, obj):
+        # With protocol 5 data of NumPy arrays is written straight from the
+        # array, dill's __reduce__() would copy it to bytes holding the GIL
+        obj_type = type(obj)
+        if obj_type.__module__ == "numpy" and obj_type.__name__ == "ndarray":
+            return obj.__reduce_ex__(5)
+        parent_reducer_override = getattr(super(), "reducer_override", None)
+        if parent_reducer_override is not None:
+            return parent_reducer_override(obj)
+        return NotImplemented
+
+
+# State kept for the whole session of the process: pipes of the parts are
+# reused by all dumps, loader threads by all loads. Owner pid protects state
+# inherited by forked processes.
+session_pid = os.getpid()
+session_channels = {}
+session_executors = {}
+# writer processes or (future, path) of writer threads of the dump in
+# progress
+active_processes = []
+active_threads = []
+# measured bytes per second of a worker, averaged over previous dumps
+worker_throughput = None
+
+
+def check_session():
+    """
+    Forked processes start a session of their own.
+    """
+    global session_pid
+    if session_pid != os.getpid():
+        session_pid = os.getpid()
+        session_channels.clear()
+        session_executors.clear()
+        active_processes.clear()
+        active_threads.clear()
+
+
+def get_channels(directory, count):
+    """
+    Named pipes for count parts, created once per directory and session.
+    """
+    check_session()
+    channels = session_channels.setdefault(directory, [])
+    while len(channels) < count:
+        path = os.path.join(
+            directory,
+            f"scorep_jupyter_parallel_marshall_{uuid.uuid4().hex}"
+            f"_{len(channels)}",
+        )
+        os.mkfifo(path)
+        channels.append(path)
+    logger.debug(f"Reusing {count} pipes in {directory}")
+    return channels[:count]
+
+
+def file_directory(file):
+    """
+    Directory of the file/pipe passed for dumping, files opened with
+    os.fdopen() are named after their descriptor.
+    """
+    try:
+        path = os.readlink(f"/proc/self/fd/{file.fileno()}")
+    except OSError:
+        path = os.path.abspath(str(file.name))
+    return os.path.dirname(path)
+
+
+def get_executor(role="loader"):
+    """
+    Threads of the session for loading or writing parts. Loaders and
+    writers don't share threads, they may wait for each other.
+    """
+    check_session()
+    if role not in session_executors:
+        session_executors[role] = concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers,
+            thread_name_prefix=f"parallel_marshall_{role}",
+        )
+    return session_executors[role]
+
+
+def choose_n_parts(payload_size):
+    """
+    Number of parts for the payload, so that every worker is busy for at
+    least min_worker_time according to the throughput of previous dumps.
+    """
+    if not adaptive:
+        return workers
+    throughput = worker_throughput or default_worker_throughput
+    n_parts = max(
+        1, min(workers, math.ceil(payload_size / throughput / min_worker_time))
+    )
+    logger.info(
+        f"Dumping {payload_size} bytes with {n_parts} of {workers} workers "
+        f"(worker throughput {throughput:.0f} bytes/s, "
+        f"{'measured' if worker_throughput else 'default'})"
+    )
+    return n_parts
+
+
+def record_throughput(payload_size, n_parts, elapsed):
+    """
+    Update throughput of a worker with the duration of the last dump.
+    """
+    global worker_throughput
+    if elapsed <= 0 or payload_size <= 0:
+        return
+    throughput = payload_size / n_parts / elapsed
+    if worker_throughput is None:
+        worker_throughput = throughput
+    else:
+        worker_throughput = 0.5 * worker_throughput + 0.5 * throughput
+    logger.info(
+        f"Dumped {payload_size} bytes with {n_parts} workers in "
+        f"{elapsed:.3f} s, worker throughput {worker_throughput:.0f} bytes/s"
+    )
+
 
 def dump(obj, file):
     global mode
-    paths = [f"{file.name}_{i}" for i in range(workers)]
+    # Only dicts and lists are split, other objects are dumped as a whole
+    n_parts = 1
+    payload_size = 0
+    if workers > 1 and isinstance(obj, (dict, list)):
+        values = obj.values() if isinstance(obj, dict) else obj
+        value_sizes = {id(value): size_estimator(value) for value in values}
+        payload_size = sum(value_sizes.values())
+        n_parts = choose_n_parts(payload_size)
+    obj_kind = type(obj).__name__ if n_parts > 1 else "object"
+
+    subobjs = []
+    shared_objects = []
+    if obj_kind != "object":
+        subobjs = list(
+            BalancedDistributionIterator(
+                obj,
+                n_parts,
+                lambda value: value_sizes[id(value)],
+                keep_identity=share_references,
+            )
+        )
+        if share_references:
+            shared_objects = find_shared_objects(subobjs)
+            if shared_objects is None:
+                logger.info("Too many objects, shared references ignored")
+                shared_objects = []
+            logger.debug(f"{len(shared_objects)} shared objects found")
+    n_shared = 1 if shared_objects else 0
+    n_paths = n_parts + n_shared
 
     if stat.S_ISREG(os.fstat(file.fileno()).st_mode):
         mode = "disk"
+        # Files must outlive the process, loader removes them
+        paths = [f"{file.name}_{i}" for i in range(n_paths)]
         for path in paths:
             open(path, "a").close()
         logger.debug("Files created")
     elif stat.S_ISFIFO(os.fstat(file.fileno()).st_mode):
         mode = "memory"
-        for path in paths:
-            os.mkfifo(path)
-        logger.debug("Pipes spawned")
+        paths = get_channels(file_directory(file), n_paths)
     else:
         logger.debug("Unrecognized type of file")
 
     # first block until loader reads filenames
+    file.write(f"{obj_kind} {n_shared}\n".encode("utf-8"))
     for path in paths:
         file.write(path.encode("utf-8") + b"\n")
     file.close()
     logger.debug("Writer communicated paths")
 
-    if workers == 1:
-        with os.fdopen(os.open(paths[0], os.O_WRONLY | os.O_CREAT), "wb") as f:
-            serializer_backend.dump(obj, f)
+    start_time = time.perf_counter()
+    if obj_kind == "object":
+        dump_subobj(obj, paths[0])
+        record_throughput(payload_size, 1, time.perf_counter() - start_time)
+        return
+
+    # Shared objects are written as the first part, others refer to them
+    # by their index
+    shared_ids = {id(shared): i for i, shared in enumerate(shared_objects)}
+    if shared_objects:
+        subobjs.insert(0, shared_objects)
+
+    if writer_backend == "thread":
+        # writer threads share the parts with the dumping process
+        executor = get_executor("writer")
+        for i, (subobj, subobj_path) in enumerate(zip(subobjs, paths)):
+            future = executor.submit(
+                dump_subobj,
+                subobj,
+                subobj_path,
+                None if i < n_shared else shared_ids,
+            )
+            active_threads.append((future, subobj_path))
+            logger.debug(f"Writer submitted part {i}")
+        try:
+            for future, _ in active_threads:
+                future.result()
+        finally:
+            active_threads.clear()
+        logger.debug("joined")
+        record_throughput(
+            payload_size, n_parts, time.perf_counter() - start_time
+        )
         return
 
-    # multi processing scheme
-    processes = []
+    # multi processing scheme, writers are forked for every dump to take
+    # over their parts of the object without serializing them
     # each of spawned writers is blocked until loader reads their subdict
-    i = 0
-    for subobj in BalancedDistributionIterator(obj, workers):
-        subobj_path = paths[i]
+    for i, (subobj, subobj_path) in enumerate(zip(subobjs, paths)):
         process = multiprocessing.Process(
-            target=dump_subobj, args=(subobj, subobj_path)
+            target=dump_subobj,
+            args=(subobj, subobj_path, None if i < n_shared else shared_ids),
         )
-        processes.append(process)
+        active_processes.append(process)
         process.start()
         logger.debug(f"Writer spawned process {i}")
-        i += 1
 
-    for process in processes:
+    for process in active_processes:
         process.join()
+    active_processes.clear()
     logger.debug("joined")
+    record_throughput(payload_size, n_parts, time.perf_counter() - start_time)
 
 
-def dump_subobj(subobj, subobj_path):
+def dump_subobj(subobj, subobj_path, shared_ids=None):
     with os.fdopen(os.open(subobj_path, os.O_WRONLY | os.O_CREAT), "wb") as f:
-        serializer_backend.dump(subobj, f)
+        if writer_backend == "thread":
+            pickler = BufferPickler(f, protocol=5)
+        elif shared_ids:
+            pickler = serializer_backend.Pickler(f)
+        else:
+            serializer_backend.dump(subobj, f)
+            return
+        if shared_ids:
+            pickler.persistent_id = lambda obj: shared_ids.get(id(obj))
+        pickler.dump(subobj)
+
 
+def load_subobj(subobj_path, shared_objects=None):
+    logger.debug(f"Loader started working with {subobj_path}")
+    with os.fdopen(os.open(subobj_path, os.O_RDONLY), "rb") as f:
+        if shared_objects:
+            unpickler = getattr(
+                serializer_backend, "Unpickler", pickle.Unpickler
+            )(f)
+            unpickler.persistent_load = shared_objects.__getitem__
+            subobj = unpickler.load()
+        else:
+            subobj = serializer_backend.load(f)
+    logger.debug(f"Loader loaded {subobj_path}")
+    return subobj
 
-# sequential loading of parallel marshalled data
+
+# parallel loading of parallel marshalled data
 def load(file):
     logger.debug("Loader started")
-    paths = file.read().decode("utf-8").splitlines()
+    header, *paths = file.read().decode("utf-8").splitlines()
     file.close()
+    obj_kind, n_shared = header.split()
+    n_shared = int(n_shared)
     logger.debug("Loader read paths")
-    data_ = {}
-
-    # unblock spawned writers one by one
-    for subdict_path in paths:
-        logger.debug(f"Loader started working with {subdict_path}")
-        with os.fdopen(os.open(subdict_path, os.O_RDONLY), "rb") as f:
-            obj = serializer_backend.load(f)
-            if isinstance(obj, dict):
-                data_.update(obj)
-            elif isinstance(obj, list):
-                data_ = []
-                data_.extend(obj)
-            logger.debug("Loader loaded subdict")
 
+    # Other parts refer to the shared objects, those are loaded first
+    shared_objects = None
+    if n_shared:
+        shared_objects = load_subobj(paths[0])
+
+    # Parts are read concurrently, so all spawned writers are unblocked at
+    # once. Reading and unpickling large buffers releases the GIL, threads
+    # avoid serializing the loaded objects again to hand them over.
+    subobjs = list(
+        get_executor().map(
+            functools.partial(load_subobj, shared_objects=shared_objects),
+            paths[n_shared:],
+        )
+    )
+
+    if obj_kind == "object":
+        data_ = subobjs[0]
+    else:
+        data_ = merge_bins(subobjs, is_list=obj_kind == "list")
+    logger.debug("Loader merged subobjects")
+
+    # Pipes belong to the session of the writer
     for path in paths:
-        if os.path.exists(path):
+        if os.path.isfile(path):
             os.unlink(path)
 
     return data_
+
+
+def cleanup(path):
+    """
+    Stop writers of an interrupted dump, which are blocked on their pipes.
+    """
+    check_session()
+    for process in active_processes:
+        if process.is_alive():
+            process.terminate()
+        process.join()
+    active_processes.clear()
+    # Threads can't be terminated, opening and closing their pipes lets
+    # them fail on writing
+    for future, subobj_path in active_threads:
+        if not future.done() and os.path.exists(subobj_path):
+            try:
+                os.close(os.open(subobj_path, os.O_RDONLY | os.O_NONBLOCK))
+            except OSError:
+                pass
+
+
+@atexit.register
+def shutdown():
+    """
+    Release pipes, loader and writer threads of the session.
+    """
+    if session_pid != os.getpid():
+        return
+    for executor in session_executors.values():
+        executor.shutdown()
+    session_executors.clear()
+    for channels in session_channels.values():
+        for path in channels:
+            if os.path.exists(path):
+                os.unlink(path)
+    session_channels.clear()
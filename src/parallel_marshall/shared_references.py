@@ -0,0 +1,55 @@
+import gc
+import types
+
+from parallel_marshall.size_estimators import buffer_size
+
+# Upper bound of objects visited when looking for shared references, above
+# that parts are serialized independently
+shared_max_objects = 1000000
+
+# Identity of these objects doesn't matter or they are pickled by reference
+ignored_types = (
+    int,
+    float,
+    complex,
+    bool,
+    str,
+    type(None),
+    type,
+    types.ModuleType,
+    types.FunctionType,
+    types.BuiltinFunctionType,
+)
+
+
+def find_shared_objects(subobjs):
+    """
+    Objects reachable from more than one part. Returns a list of them, or
+    None if there are too many objects to analyze.
+    """
+    owners = {}
+    objects = {}
+    for part, subobj in enumerate(subobjs):
+        # Keys of the parts are never shared, start with the values
+        pending = list(subobj.values())
+        while pending:
+            obj = pending.pop()
+            if isinstance(obj, ignored_types):
+                continue
+            owner = owners.get(id(obj))
+            if owner == part or owner == -1:
+                continue
+            if owner is None:
+                owners[id(obj)] = part
+                objects[id(obj)] = obj
+                if len(owners) > shared_max_objects:
+                    return None
+            else:
+                # Reached from another part, mark as shared
+                owners[id(obj)] = -1
+            # Data of buffers (e.g. base of NumPy views) isn't followed,
+            # chunks of a split array must not be treated as shared
+            if buffer_size(obj) is None:
+                pending.extend(gc.get_referents(obj))
+
+    return [objects[key] for key, owner in owners.items() if owner == -1]
@@ -0,0 +1,106 @@
+import gc
+import itertools
+import sys
+import types
+
+# Containers with more items are sized from a sample of their items
+sample_threshold = 1000
+sample_size = 100
+
+# Objects pickled by reference, their contents aren't serialized
+by_reference_types = (type, types.ModuleType, types.FunctionType)
+sampled_types = (list, tuple, set, frozenset, dict)
+
+
+def shallow_size(obj):
+    """
+    Size of the object itself, without objects it references.
+    """
+    return sys.getsizeof(obj)
+
+
+def buffer_size(obj):
+    """
+    Size of the data of buffer protocol objects (e.g. NumPy arrays, also
+    views of other arrays), None for other objects.
+    """
+    try:
+        with memoryview(obj) as view:
+            return view.nbytes
+    except (TypeError, ValueError):
+        return None
+
+
+def sample_items(obj):
+    """
+    Evenly spaced sample of the items of a large container.
+    """
+    if isinstance(obj, dict):
+        items = itertools.chain.from_iterable(obj.items())
+        length = 2 * len(obj)
+    else:
+        items = iter(obj)
+        length = len(obj)
+    step = max(length // sample_size, 1)
+    return list(itertools.islice(items, 0, None, step)), length
+
+
+def deep_size(obj):
+    """
+    Size of the object including all objects reachable from it. Buffer
+    protocol objects count with the size of their data, large containers
+    are sized from a sample of their items.
+    """
+    size = 0
+    visited = set()
+    pending = [obj]
+    while pending:
+        obj = pending.pop()
+        if id(obj) in visited:
+            continue
+        visited.add(id(obj))
+
+        nbytes = buffer_size(obj)
+        if nbytes is not None:
+            # Views reference their base array, which isn't followed, so
+            # that data isn't counted twice
+            size += max(sys.getsizeof(obj), nbytes)
+            continue
+        size += sys.getsizeof(obj)
+        if isinstance(obj, by_reference_types):
+            continue
+        elif isinstance(obj, sampled_types) and len(obj) > sample_threshold:
+            sample, length = sample_items(obj)
+            sample_sizes = [deep_size(item) for item in sample]
+            size += sum(sample_sizes) * length // len(sample)
+        else:
+            pending.extend(gc.get_referents(obj))
+    return size
+
+
+class CountingWriter:
+    """
+    File-like object counting written bytes instead of storing them.
+    """
+
+    def __init__(self):
+        self.size = 0
+
+    def write(self, data):
+        with memoryview(data) as view:
+            self.size += view.nbytes
+            return view.nbytes
+
+
+def serialized_size(obj, serializer):
+    """
+    Size of the object serialized with the serializer module. Large
+    containers are sized by serializing a sample of their items.
+    """
+    writer = CountingWriter()
+    if isinstance(obj, sampled_types) and len(obj) > sample_threshold:
+        sample, length = sample_items(obj)
+        serializer.dump(sample, writer)
+        return writer.size * length // len(sample)
+    serializer.dump(obj, writer)
+    return writer.size
@@ -0,0 +1,237 @@
+import ctypes
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+# File of a cached subsystem library directory listing the libraries to
+# preload
+subsystem_preload_name = "ld_preload"
+# Cached subsystem libraries kept, the least recently used are removed
+subsystem_cache_entries = 8
+
+
+def parse_scorep_binding_args(scorep_binding_args):
+    """
+    Split Score-P Python bindings arguments the same way as
+    `python -m scorep` does. Returns arguments for scorep-config, instrumenter
+    type, whether the instrumenter is enabled and whether temporary files of
+    the bindings are kept.
+    """
+    import scorep.instrumenter
+
+    scorep_config = []
+    if scorep.instrumenter.has_c_instrumenter():
+        instrumenter_type = "cProfile"
+    else:
+        instrumenter_type = "profile"
+    enable_instrumenter = True
+    keep_files = False
+
+    for arg in scorep_binding_args:
+        if not arg:
+            continue
+        elif arg == "--mpi":
+            scorep_config.append("--mpp=mpi")
+        elif arg == "--keep-files":
+            keep_files = True
+        elif arg in ["--nopython", "--noinstrumenter"]:
+            enable_instrumenter = False
+        elif arg.startswith("--instrumenter-type"):
+            instrumenter_type = arg.split("=")[1]
+        elif arg in ["--verbose", "-v"] or arg.startswith(
+            "--instrumenter-file"
+        ):
+            continue
+        elif arg.startswith("-"):
+            scorep_config.append(arg)
+
+    return scorep_config, instrumenter_type, enable_instrumenter, keep_files
+
+
+def init_scorep_bindings(scorep_binding_args):
+    """
+    Initialize Score-P in the running interpreter. Instead of re-executing it
+    with LD_PRELOAD as `python -m scorep` does, the preload libraries are
+    loaded with dlopen(). Returns the instrumenter.
+    """
+    import scorep.instrumenter
+
+    scorep_config, instrumenter_type, enable_instrumenter, _ = (
+        parse_scorep_binding_args(scorep_binding_args)
+    )
+
+    environ = subsystem_environment(scorep_config)
+    subsystem_dir = environ["SCOREP_PYTHON_BINDINGS_TEMP_DIR"]
+    for library in environ["LD_PRELOAD"].replace(":", " ").split():
+        # Subsystem library is given by name, found via LD_LIBRARY_PATH
+        if os.path.exists(os.path.join(subsystem_dir, library)):
+            library = os.path.join(subsystem_dir, library)
+        ctypes.CDLL(library, mode=ctypes.RTLD_GLOBAL)
+
+    return scorep.instrumenter.get_instrumenter(
+        enable_instrumenter, instrumenter_type
+    )
+
+
+def scorep_installation_id():
+    """
+    Identifies the installed Score-P and Python bindings, changes when
+    either of them is reinstalled.
+    """
+    import scorep
+
+    paths = [shutil.which("scorep-config") or "", scorep.__file__]
+    return tuple(
+        (path, os.stat(path).st_mtime_ns)
+        for path in paths
+        if path and os.path.exists(path)
+    )
+
+
+def subsystem_cache_dir():
+    return os.getenv(
+        "SCOREP_JUPYTER_SUBSYSTEM_CACHE_DIR",
+        os.path.join(
+            os.getenv("XDG_CACHE_HOME", os.path.expanduser("~/.cache")),
+            "scorep_jupyter",
+            "subsystem",
+        ),
+    )
+
+
+def cached_subsystem(scorep_config):
+    """
+    Directory of the subsystem library generated by the bindings for the
+    Score-P configuration and the libraries to preload with it. The
+    library is generated once per configuration and installation of
+    Score-P, later calls (also of other kernels) use the cached one.
+    Adding a library evicts the least recently used ones.
+    """
+    key = hashlib.sha256(
+        json.dumps([scorep_config, scorep_installation_id()]).encode()
+    ).hexdigest()
+    cache_dir = subsystem_cache_dir()
+    subsystem_dir = os.path.join(cache_dir, key)
+    preload_path = os.path.join(subsystem_dir, subsystem_preload_name)
+    if not os.path.exists(preload_path):
+        import scorep.subsystem
+
+        # Environment changes of the bindings are only meant for
+        # re-execution, keep the libraries they generated
+        environ_backup = dict(os.environ)
+        scorep.subsystem.init_environment(list(scorep_config), False)
+        temp_dir = os.environ["SCOREP_PYTHON_BINDINGS_TEMP_DIR"]
+        preload = os.environ["LD_PRELOAD"]
+        os.environ.clear()
+        os.environ.update(environ_backup)
+        # Libraries preloaded by the user are added after Score-P's
+        ld_preload = os.environ.get("LD_PRELOAD", "")
+        if ld_preload and preload.endswith(ld_preload):
+            preload = preload[: -len(ld_preload)].strip()
+
+        with open(os.path.join(temp_dir, subsystem_preload_name), "w") as file:
+            file.write(preload)
+        # Published by renaming, concurrently generated copies are dropped
+        os.makedirs(cache_dir, exist_ok=True)
+        staging_dir = tempfile.mkdtemp(dir=cache_dir)
+        shutil.copytree(temp_dir, staging_dir, dirs_exist_ok=True)
+        shutil.rmtree(temp_dir, ignore_errors=True)
+        try:
+            os.rename(staging_dir, subsystem_dir)
+        except OSError:
+            shutil.rmtree(staging_dir, ignore_errors=True)
+        evict_subsystems(cache_dir, subsystem_cache_entries)
+    else:
+        # Modification time tracks the use, atime might not be updated
+        os.utime(subsystem_dir)
+
+    with open(preload_path, "r") as file:
+        return subsystem_dir, file.read()
+
+
+def evict_subsystems(cache_dir, keep):
+    """
+    Remove cached subsystem libraries except the keep most recently used.
+    Staging directories of libraries being generated aren't touched.
+    """
+    entries = []
+    for entry in os.scandir(cache_dir):
+        if (
+            entry.is_dir()
+            and len(entry.name) == 64
+            and all(c in "0123456789abcdef" for c in entry.name)
+        ):
+            entries.append((entry.stat().st_mtime_ns, entry.path))
+    entries.sort(reverse=True)
+    for _, path in entries[keep:]:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def subsystem_environment(scorep_config):
+    """
+    Environment variables `python -m scorep` sets before re-executing the
+    interpreter, with the subsystem library taken from the cache.
+    """
+    return preload_variables(*cached_subsystem(scorep_config))
+
+
+def preload_variables(subsystem_dir, preload):
+    """
+    LD_PRELOAD and LD_LIBRARY_PATH with the subsystem library and the
+    libraries to preload, added to those of the current environment.
+    """
+    ld_preload = os.environ.get("LD_PRELOAD", "")
+    ld_library_path = os.environ.get("LD_LIBRARY_PATH", "")
+    return {
+        "LD_PRELOAD": f"{preload} {ld_preload}".strip(),
+        "SCOREP_LD_PRELOAD_BACKUP": ld_preload,
+        "SCOREP_PYTHON_BINDINGS_TEMP_DIR": subsystem_dir,
+        "LD_LIBRARY_PATH": (
+            f"{subsystem_dir}:{ld_library_path}"
+            if ld_library_path
+            else subsystem_dir
+        ),
+    }
+
+
+def binding_subsystem(scorep_binding_args):
+    """
+    Subsystem library directory and libraries to preload for the binding
+    arguments, see cached_subsystem().
+    """
+    scorep_config, _, _, _ = parse_scorep_binding_args(scorep_binding_args)
+    return cached_subsystem(scorep_config)
+
+
+class PreloadEnvironment:
+    """
+    Environment of the interpreter re-executed by `python -m scorep`, i.e.
+    LD_PRELOAD of the Score-P libraries and the subsystem library. Bindings
+    launched with it run the script directly. The subsystem is looked up
+    once for the binding arguments and again when they or the Score-P
+    installation change, the LD_* variables are built from the current
+    environment on every call.
+    """
+
+    def __init__(self):
+        self.key = None
+        self.subsystem = None
+
+    def get(self, scorep_binding_args):
+        key = (tuple(scorep_binding_args), scorep_installation_id())
+        # Subsystem might have been evicted from the cache by another kernel
+        if key != self.key or not os.path.isdir(self.subsystem[0]):
+            self.subsystem = binding_subsystem(scorep_binding_args)
+            self.key = key
+        environ = preload_variables(*self.subsystem)
+        environ["SCOREP_PYTHON_BINDINGS_INITIALISED"] = "true"
+        return environ
+
+    def clear(self):
+        """
+        Forget the subsystem, its library stays in the shared cache.
+        """
+        self.key = None
+        self.subsystem = None
@@ -0,0 +1,189 @@
+import contextlib
+import importlib
+import os
+import sys
+import time
+import traceback
+
+from scorep_jupyter.bindings import init_scorep_bindings
+from scorep_jupyter.phase_report import write_subprocess_report
+import scorep_jupyter.userpersistence
+from scorep_jupyter.userpersistence import (
+    dump_runtime,
+    phase_region_prefix,
+    scorep_script_name,
+)
+
+
+class ForkedProcess:
+    """
+    Counterpart of subprocess.Popen for a forked kernel process, providing
+    what the kernel needs to observe it.
+    """
+
+    def __init__(self, pid, stdout, stderr):
+        self.pid = pid
+        self.stdout = stdout
+        self.stderr = stderr
+        self.returncode = None
+
+    def poll(self):
+        if self.returncode is None:
+            pid, status = os.waitpid(self.pid, os.WNOHANG)
+            if pid:
+                self.set_returncode(status)
+        return self.returncode
+
+    def wait(self):
+        if self.returncode is None:
+            _, status = os.waitpid(self.pid, 0)
+            self.set_returncode(status)
+        return self.returncode
+
+    def set_returncode(self, status):
+        if os.WIFSIGNALED(status):
+            self.returncode = -os.WTERMSIG(status)
+        else:
+            self.returncode = os.WEXITSTATUS(status)
+
+
+def fork_scorep_process(
+    code,
+    globals_,
+    scorep_binding_args,
+    pershelper,
+    cell_name="cell",
+    environ=None,
+    dump=True,
+    report=False,
+):
+    """
+    Fork the kernel and run the code with Score-P instrumentation in the
+    child. The child inherits notebook namespace copy-on-write, so only
+    variables written by the code are dumped back to the kernel. Variables
+    in environ are set in the environment of the child. Without dump,
+    nothing is dumped back. With report, the phase report is written even
+    if it wasn't requested.
+    """
+    stdout_read, stdout_write = os.pipe()
+    stderr_read, stderr_write = os.pipe()
+
+    pid = os.fork()
+    if pid == 0:
+        os.close(stdout_read)
+        os.close(stderr_read)
+        os.dup2(stdout_write, 1)
+        os.dup2(stderr_write, 2)
+        os.close(stdout_write)
+        os.close(stderr_write)
+        run_forked_child(
+            code,
+            globals_,
+            scorep_binding_args,
+            pershelper,
+            cell_name,
+            environ or {},
+            dump,
+            report,
+        )
+
+    os.close(stdout_write)
+    os.close(stderr_write)
+    return ForkedProcess(
+        pid, os.fdopen(stdout_read, "rb"), os.fdopen(stderr_read, "rb")
+    )
+
+
+def run_forked_child(
+    code,
+    globals_,
+    scorep_binding_args,
+    pershelper,
+    cell_name,
+    environ,
+    dump=True,
+    report=False,
+):
+    """
+    Body of the forked child, never returns. Kernel threads and sockets
+    don't exist in the child, so it must not run kernel exit handlers.
+    Persistence is dumped to files, the kernel loads it after the child
+    exited and closed its streams.
+    """
+    # Kernel streams are sent to the frontend, write to pipes instead
+    sys.stdout = os.fdopen(1, "w", buffering=1)
+    sys.stderr = os.fdopen(2, "w", buffering=1)
+
+    exit_code = 0
+    tracer = None
+    try:
+        os.environ.update(environ)
+        tracer = init_scorep_bindings(scorep_binding_args)
+        import scorep.instrumenter
+        import scorep.user
+
+        timestamps = [("startup", time.time())]
+        cell_region = phase_region_prefix + cell_name
+        if pershelper.is_phase_regions:
+            scorep.user.region_begin(cell_region)
+        try:
+            tracer.run(
+                compile(code, scorep_script_name, "exec"), globals_, globals_
+            )
+        finally:
+            if pershelper.is_phase_regions:
+                scorep.user.region_end(cell_region)
+        timestamps.append(("cell", time.time()))
+        transfer_bytes = 0
+        if dump:
+            transfer_bytes = dump_persistence(globals_, pershelper)
+            timestamps.append(("dump", time.time()))
+        if pershelper.phase_report_format or report:
+            write_subprocess_report(timestamps, transfer_bytes)
+    except BaseException:
+        traceback.print_exc()
+        exit_code = 1
+    finally:
+        # Exit handlers don't run on os._exit(), write measurement results
+        if tracer is not None:
+            tracer.force_finalize()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(exit_code)
+
+
+def dump_persistence(globals_, pershelper):
+    """
+    Dump persistence of the forked child to files, returns bytes written.
+    """
+    import scorep.instrumenter
+
+    marshaller = importlib.import_module(pershelper.marshaller)
+    dump_function = getattr(
+        scorep_jupyter.userpersistence, pershelper.dump_function("subprocess")
+    )
+    # Persistence is dumped after the instrumented run, it's only
+    # recorded if persistence tracing was requested
+    dump_region = ""
+    if pershelper.is_phase_regions:
+        dump_region = phase_region_prefix + "dump"
+    persistence_context = contextlib.nullcontext()
+    if pershelper.is_persistence_traced:
+        persistence_context = scorep.instrumenter.enable(dump_region)
+    elif dump_region:
+        persistence_context = scorep.instrumenter.disable(dump_region)
+    with persistence_context:
+        transfer_bytes = dump_runtime(
+            os.environ,
+            sys.path,
+            pershelper.paths["subprocess"]["os_environ"],
+            pershelper.paths["subprocess"]["sys_path"],
+            marshaller,
+        )
+        transfer_bytes += dump_function(
+            pershelper.subprocess_variables,
+            globals_,
+            pershelper.paths["subprocess"]["var"],
+            marshaller,
+        )
+    return transfer_bytes
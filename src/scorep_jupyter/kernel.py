@@ -4,6 +4,7 @@ import logging.config
 import os
 import re
 import shutil
+import statistics
 import subprocess
 import sys
 import threading
@@ -14,6 +15,20 @@ from typing import IO, AnyStr, Callable, List
 
 from ipykernel.ipkernel import IPythonKernel
 
+from scorep_jupyter.bindings import PreloadEnvironment
+from scorep_jupyter.forked_process import fork_scorep_process
+from scorep_jupyter.phase_report import PhaseReport
+from scorep_jupyter.repetitions import (
+    parse_repetitions,
+    repetition_runs,
+)
+from scorep_jupyter.standby_process import (
+    StandbyProcess,
+    remove_standby_scripts,
+    run_script,
+    standby_file_prefix,
+)
+from scorep_jupyter.kernel_timeline import KernelTimeline
 from scorep_jupyter.kernel_messages import (
     KernelErrorCode,
     KERNEL_ERROR_MESSAGES,
@@ -21,6 +36,9 @@ from scorep_jupyter.kernel_messages import (
 )
 from scorep_jupyter.userpersistence import PersHelper, scorep_script_name
 from scorep_jupyter.userpersistence import magics_cleanup, create_busy_spinner
+from scorep_jupyter.userpersistence import extract_bound_names
+from scorep_jupyter.userpersistence import notebook_runtime
+from scorep_jupyter.scorep_session import ScorepSession
 from .logging_config import LOGGING
 
 # import scorep_jupyter.multinode_monitor.slurm_monitor as slurm_monitor
@@ -77,6 +95,13 @@ class scorep_jupyterKernel(IPythonKernel):
         self.blacklist_prefixes = ["%lsmagic"]
 
         self.scorep_binding_args = []
+        self.preload_environment = PreloadEnvironment()
+        # Subprocess waiting for the next instrumented cell
+        self.standby = StandbyProcess()
+        # Instrumented cells run in one subprocess until a normal cell needs
+        # their variables
+        self.session_enabled = False
+        self.session = None
 
         os.environ["SCOREP_JUPYTER_PERSISTENCE_DIR"] = "./"
         self.pershelper = PersHelper("dill", "memory")
@@ -101,6 +126,11 @@ class scorep_jupyterKernel(IPythonKernel):
         except ModuleNotFoundError:
             self.scorep_python_available_ = False
         self.launch_vampir_requested = False
+        # Number of experiment directories assigned by the kernel
+        self.experiment_count = 0
+        # Spans of the kernel's own work, recorded if
+        # SCOREP_JUPYTER_KERNEL_TIMELINE names a directory
+        self.timeline = KernelTimeline()
         logging.config.dictConfig(LOGGING)
         self.log = logging.getLogger("kernel")
 
@@ -173,6 +203,14 @@ class scorep_jupyterKernel(IPythonKernel):
                 f"Kernel uses '{self.pershelper.marshaller}' marshaller in "
                 f"'{self.pershelper.mode}' mode."
             )
+            if mode == "fork" and self.pershelper.mode == "fork":
+                self.cell_output(
+                    "KernelWarning: In 'fork' mode, Score-P libraries are "
+                    "loaded with dlopen() instead of LD_PRELOAD, adapters "
+                    "relying on preloading (pthread, I/O, memory) record "
+                    "nothing.",
+                    "stderr",
+                )
         else:
             self.cell_output(
                 f"KernelWarning: Currently in {self.mode}, command ignored.",
@@ -466,11 +504,28 @@ class scorep_jupyterKernel(IPythonKernel):
         """
         self.log.info("Executing Score-P instrumented code...")
         self.pershelper.set_dump_report_level()
+        self.pershelper.set_transfer_settings()
+        report = PhaseReport(self.timeline)
+        # Variables sent to the subprocess or inherited by the forked one
+        # must not be placeholders
+        self.pershelper.materialize(
+            code if self.pershelper.is_read_set_transfer else None,
+            self.shell.user_ns,
+        )
         # Set up files/pipes for persistence communication
+        report.start()
+        persistence_dir = self.pershelper.place_persistence(self.shell.user_ns)
+        if self.pershelper.mode == "disk":
+            self.log.info(f"Persistence files placed in {persistence_dir}")
+            if self.pershelper.is_dump_detailed_report:
+                self.cell_output(
+                    f"Persistence files placed in {persistence_dir}\n"
+                )
         if not self.pershelper.preprocess():
             self.pershelper.postprocess()
             self.log_error(KernelErrorCode.PERSISTENCE_SETUP_FAIL)
             return self.standard_reply()
+        report.stop("preprocess")
 
         self.log.debug("Persistence communication set up successfully.")
 
@@ -478,13 +533,20 @@ class scorep_jupyterKernel(IPythonKernel):
         # Transmit user persistence and updated sys.path from Jupyter
         # notebook to subprocess After running the code, transmit subprocess
         # persistence back to Jupyter notebook
-        with os.fdopen(
-            os.open(scorep_script_name, os.O_WRONLY | os.O_CREAT), "w"
-        ) as file:
-            file.write(self.pershelper.subprocess_wrapper(code))
-        self.log.debug(
-            f"Code written to temporary script: {scorep_script_name}"
-        )
+        # Cell code is recorded as a user region named after the cell
+        cell_name = f"cell_{self.shell.execution_count}"
+        if self.pershelper.mode == "fork":
+            # Forked process runs the code in inherited notebook namespace
+            with self.timeline.span("parse"):
+                self.pershelper.parse(code, "subprocess")
+        else:
+            with self.timeline.span("subprocess_wrapper"), os.fdopen(
+                os.open(scorep_script_name, os.O_WRONLY | os.O_CREAT), "w"
+            ) as file:
+                file.write(self.pershelper.subprocess_wrapper(code, cell_name))
+            self.log.debug(
+                f"Code written to temporary script: {scorep_script_name}"
+            )
 
         # For disk mode use implicit synchronization between kernel and
         # subprocess: await jupyter_dump, subprocess.wait(),
@@ -492,6 +554,7 @@ class scorep_jupyterKernel(IPythonKernel):
         # subprocess Run in a "silent" way to not increase cells counter
         if self.pershelper.mode == "disk":
             self.log.debug("Executing Jupyter dump for disk mode.")
+            report.start_ghost_cell()
             reply_status_dump = await super().do_execute(
                 self.pershelper.jupyter_dump(),
                 silent,
@@ -500,6 +563,10 @@ class scorep_jupyterKernel(IPythonKernel):
                 allow_stdin=allow_stdin,
                 cell_id=cell_id,
             )
+            report.stop_ghost_cell("jupyter_dump", "Jupyter -> Score-P")
+            self.pershelper.transfer_size = report.transfer_bytes[
+                "Jupyter -> Score-P"
+            ]
 
             if reply_status_dump["status"] != "ok":
                 self.log_error(
@@ -512,42 +579,48 @@ class scorep_jupyterKernel(IPythonKernel):
         # Launch subprocess with Jupyter notebook environment
         self.log.debug("Preparing subprocess execution.")
 
-        cmd = (
-            [PYTHON_EXECUTABLE, "-m", "scorep"]
-            + self.scorep_binding_args
-            + [scorep_script_name]
-        )
-        self.log.debug(f"Subprocess command: {' '.join(cmd)}")
-
-        scorep_env = {
-            key: os.environ[key]
-            for key in os.environ
-            if key.startswith("SCOREP_")
-        }
-        proc_env = {
-            "PATH": os.environ.get("PATH", ""),
-            "LD_LIBRARY_PATH": os.environ.get("LD_LIBRARY_PATH", ""),
-            "PYTHONPATH": os.environ.get("PYTHONPATH", ""),
-            "EBPYTHONPREFIXES": os.environ.get("EBPYTHONPREFIXES", ""),
-            "PYTHONUNBUFFERED": "x",
-        }
-        proc_env.update(scorep_env)
-        # scorep path, subprocess observation
-
-        # determine datetime for figuring out scorep path after execution
-        dt = datetime.datetime.now()
-        hour = dt.strftime("%H")
-        minute = dt.strftime("%M")
-
-        proc = subprocess.Popen(
-            cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=proc_env
-        )
+        launch_time = time.time()
+        launch_span = self.timeline.begin("launch_subprocess")
+        if self.pershelper.mode == "fork":
+            assigned_directory = self.assign_experiment_directory()
+            scorep_folder = assigned_directory or os.environ.get(
+                "SCOREP_EXPERIMENT_DIRECTORY"
+            )
+            proc = fork_scorep_process(
+                code,
+                self.shell.user_ns,
+                self.scorep_binding_args,
+                self.pershelper,
+                cell_name,
+                {"SCOREP_EXPERIMENT_DIRECTORY": scorep_folder},
+            )
+        else:
+            # Standby process started after the previous cell, unless the
+            # launch settings or the notebook runtime changed since then
+            cmd, proc_env = self.scorep_launch_settings()
+            runtime = notebook_runtime()
+            proc, assigned_directory = self.standby.take(
+                cmd, proc_env, runtime
+            )
+            if proc is None:
+                runtime = self.start_standby_process(
+                    cmd, proc_env, self.assign_experiment_directory()
+                )
+                proc, assigned_directory = self.standby.take(
+                    cmd, proc_env, runtime
+                )
+            run_script(proc, scorep_script_name)
+            scorep_folder = assigned_directory or os.environ.get(
+                "SCOREP_EXPERIMENT_DIRECTORY"
+            )
+        self.timeline.end(launch_span)
         self.log.debug(f"Subprocess started with PID {proc.pid}")
 
         # For memory mode jupyter_dump and jupyter_update must be awaited
         # concurrently to the running subprocess
         if self.pershelper.mode == "memory":
             self.log.debug("Executing Jupyter dump for memory mode.")
+            report.start_ghost_cell()
             reply_status_dump = await super().do_execute(
                 self.pershelper.jupyter_dump(),
                 silent,
@@ -556,6 +629,7 @@ class scorep_jupyterKernel(IPythonKernel):
                 allow_stdin=allow_stdin,
                 cell_id=cell_id,
             )
+            report.stop_ghost_cell("jupyter_dump", "Jupyter -> Score-P")
             if reply_status_dump["status"] != "ok":
                 self.log_error(
                     KernelErrorCode.PERSISTENCE_DUMP_FAIL,
@@ -566,6 +640,10 @@ class scorep_jupyterKernel(IPythonKernel):
 
         self.start_reading_scorep_process_streams(proc, is_multicell_final)
 
+        # Forked process dumps persistence to files before it exits
+        if self.pershelper.mode == "fork":
+            with self.timeline.span("wait_subprocess"):
+                proc.wait()
         if proc.poll():
             self.pershelper.postprocess()
             self.log_error(
@@ -577,6 +655,7 @@ class scorep_jupyterKernel(IPythonKernel):
 
         # Ghost cell - load subprocess persistence back to Jupyter notebook
         # Run in a "silent" way to not increase cells counter
+        report.start()
         reply_status_update = await super().do_execute(
             self.pershelper.jupyter_update(code),
             silent,
@@ -585,6 +664,7 @@ class scorep_jupyterKernel(IPythonKernel):
             allow_stdin=allow_stdin,
             cell_id=cell_id,
         )
+        report.stop("jupyter_update")
 
         if reply_status_update["status"] != "ok":
             self.log_error(
@@ -595,52 +675,503 @@ class scorep_jupyterKernel(IPythonKernel):
             self.pershelper.postprocess()
             return reply_status_update
 
-        # Determine directory to which trace files were saved by Score-P
-        scorep_folder = ""
-        if "SCOREP_EXPERIMENT_DIRECTORY" in os.environ:
-            self.log.debug(f'{os.environ["SCOREP_EXPERIMENT_DIRECTORY"]=}')
-            scorep_folder = os.environ["SCOREP_EXPERIMENT_DIRECTORY"]
+        if self.pershelper.phase_report_format:
+            # In memory mode the subprocess might still write its report
+            with self.timeline.span("wait_subprocess"):
+                proc.wait()
+            report.add_subprocess_report(launch_time, "Score-P -> Jupyter")
+
+        # Report directory to which trace files were saved by Score-P
+        report.start()
+        scorep_folder = self.report_experiment_directory(
+            proc, assigned_directory
+        )
+        report.stop("experiment_directory")
+        if self.pershelper.phase_report_format == "json":
+            self.cell_output(f"\n{report.to_json()}\n")
+        elif self.pershelper.phase_report_format:
+            self.cell_output(f"\n{report.to_text()}\n")
+        with self.timeline.span("postprocess"):
+            self.pershelper.postprocess()
+
+        # Optional Vampir launch
+        if self.launch_vampir_requested and scorep_folder:
+            with self.timeline.span("launch_vampir"):
+                self.try_launch_vampir(scorep_folder)
+
+        with self.timeline.span("spawn_standby_process"):
+            self.spawn_standby_process()
+        return self.standard_reply()
+
+    async def repeat_execute(
+        self,
+        code,
+        repetitions,
+        silent,
+        user_expressions=None,
+        allow_stdin=False,
+        *,
+        cell_id=None,
+    ):
+        """
+        Execute the code repeatedly with Score-P instrumentation, starting
+        from the same notebook state each time. Repetitions run in forked
+        kernel processes whatever the mode, so the state isn't transferred
+        to them. Each one gets its own experiment directory, variables are
+        loaded back from the final one.
+        """
+        if not hasattr(os, "fork"):
             self.cell_output(
-                f"Instrumentation results can be found in {scorep_folder}"
+                "KernelWarning: Repetitions require os.fork, "
+                "command ignored.",
+                "stderr",
             )
-        else:
-            # Find last created directory with scorep* name
-            # TODO: Directory isn't created local when running scorep-collector
-            max_iterations = 5
-            while max_iterations > 0:
-                # regular scorep folders always: scorep-YYYYMMDD_HHMM_XXXXXXX
-                scorep_dirs = [
-                    d
-                    for d in os.listdir(".")
-                    if os.path.isdir(d) and "scorep" in d and "_" in d
-                ]
-                if scorep_dirs:
-                    scorep_folder = max(scorep_dirs, key=os.path.getmtime)
-                    folder_time = int(scorep_folder.split("_")[1])
-                    start_time = int(hour + minute)
-                    if folder_time >= start_time:
-                        break
-                    time.sleep(1)
-                    max_iterations -= 1
-
-            if max_iterations == 0:
-                self.cell_output(
-                    "KernelWarning: Path of Instrumentation results could "
-                    "not be determined or were not saved locally.",
-                    "stderr",
+            return self.standard_reply()
+        if self.session is not None:
+            # Repetitions start from the state of the session
+            await self.end_session(
+                silent, user_expressions, allow_stdin, cell_id=cell_id
+            )
+        mode = self.pershelper.mode
+        self.pershelper.mode = "fork"
+        try:
+            reply_status = await self.run_repetitions(
+                code,
+                repetitions,
+                silent,
+                user_expressions,
+                allow_stdin,
+                cell_id=cell_id,
+            )
+        finally:
+            self.pershelper.mode = mode
+        with self.timeline.span("spawn_standby_process"):
+            self.spawn_standby_process()
+        return reply_status
+
+    async def run_repetitions(
+        self,
+        code,
+        repetitions,
+        silent,
+        user_expressions=None,
+        allow_stdin=False,
+        *,
+        cell_id=None,
+    ):
+        self.log.info(
+            f"Executing Score-P instrumented code {repetitions} times..."
+        )
+        self.pershelper.set_dump_report_level()
+        self.pershelper.set_transfer_settings()
+        self.pershelper.materialize(
+            code if self.pershelper.is_read_set_transfer else None,
+            self.shell.user_ns,
+        )
+        self.pershelper.place_persistence(self.shell.user_ns)
+        if not self.pershelper.preprocess():
+            self.pershelper.postprocess()
+            self.log_error(KernelErrorCode.PERSISTENCE_SETUP_FAIL)
+            return self.standard_reply()
+        with self.timeline.span("parse"):
+            self.pershelper.parse(code, "subprocess")
+
+        cell_name = f"cell_{self.shell.execution_count}"
+        configured_directory = os.environ.get("SCOREP_EXPERIMENT_DIRECTORY")
+        cell_times = []
+        for repetition, directory, dump in repetition_runs(
+            repetitions, configured_directory, self.assign_experiment_directory
+        ):
+            self.cell_output(f"Repetition {repetition}/{repetitions}\n")
+            launch_time = time.time()
+            with self.timeline.span(
+                "launch_subprocess", repetition=repetition
+            ):
+                proc = fork_scorep_process(
+                    code,
+                    self.shell.user_ns,
+                    self.scorep_binding_args,
+                    self.pershelper,
+                    cell_name,
+                    {"SCOREP_EXPERIMENT_DIRECTORY": directory},
+                    dump=dump,
+                    report=True,
                 )
-            else:
+            self.start_reading_scorep_process_streams(proc, False)
+            with self.timeline.span("wait_subprocess"):
+                proc.wait()
+            if proc.returncode:
+                self.pershelper.postprocess()
                 self.cell_output(
-                    f"Instrumentation results can be found in "
-                    f"{os.getcwd()}/{scorep_folder}"
+                    f"Repetition {repetition}/{repetitions} failed.\n",
+                    "stderr",
                 )
-        self.pershelper.postprocess()
+                self.log_error(KernelErrorCode.SCOREP_SUBPROCESS_FAIL)
+                return self.standard_reply()
+            report = PhaseReport()
+            report.add_subprocess_report(launch_time, "Score-P -> Jupyter")
+            cell_times.append(report.durations["cell"])
+            self.report_experiment_directory(proc, directory)
 
-        # Optional Vampir launch
+        # Ghost cell - load persistence of the final repetition
+        reply_status_update = await super().do_execute(
+            self.pershelper.jupyter_update(code),
+            silent,
+            store_history=False,
+            user_expressions=user_expressions,
+            allow_stdin=allow_stdin,
+            cell_id=cell_id,
+        )
+        if reply_status_update["status"] != "ok":
+            self.log_error(
+                KernelErrorCode.PERSISTENCE_LOAD_FAIL,
+                direction="Score-P -> Jupyter",
+                optional_hint=get_scorep_process_error_hint(),
+            )
+            self.pershelper.postprocess()
+            return reply_status_update
+
+        self.cell_output(
+            f"Cell wall time over {repetitions} repetitions: "
+            f"min {min(cell_times):.3f} s, "
+            f"median {statistics.median(cell_times):.3f} s, "
+            f"max {max(cell_times):.3f} s\n"
+        )
+        with self.timeline.span("postprocess"):
+            self.pershelper.postprocess()
+        if self.launch_vampir_requested and os.path.isdir(directory):
+            with self.timeline.span("launch_vampir"):
+                self.try_launch_vampir(directory)
+        return self.standard_reply()
+
+    def enable_scorep_session(self):
+        """
+        Run following instrumented cells in one session subprocess.
+        """
+        if self.pershelper.mode == "fork":
+            self.cell_output(
+                "KernelWarning: Sessions are not supported in fork mode, "
+                "command ignored.",
+                "stderr",
+            )
+            return self.standard_reply()
+        self.session_enabled = True
+        self.cell_output(
+            "Session enabled. Instrumented cells will run in one Score-P "
+            "process, which ends when a normal cell needs its variables."
+        )
+        return self.standard_reply()
+
+    async def disable_scorep_session(
+        self, silent, user_expressions=None, allow_stdin=False, *, cell_id=None
+    ):
+        """
+        End the session, loading its variables, and stop starting sessions.
+        """
+        self.session_enabled = False
+        if self.session is not None:
+            await self.end_session(
+                silent, user_expressions, allow_stdin, cell_id=cell_id
+            )
+        self.cell_output("Session disabled.")
+        return self.standard_reply()
+
+    async def session_execute(
+        self,
+        code,
+        silent,
+        user_expressions=None,
+        allow_stdin=False,
+        *,
+        cell_id=None,
+    ):
+        """
+        Execute the instrumented cell in the session subprocess, which is
+        started with the notebook persistence by the first cell of a session.
+        """
+        if self.session is not None and not self.session.is_alive():
+            self.log_error(KernelErrorCode.SCOREP_SUBPROCESS_FAIL)
+            self.abort_session()
+        if self.session is None:
+            reply_status = await self.start_session(
+                silent, user_expressions, allow_stdin, cell_id=cell_id
+            )
+            if reply_status is not None:
+                return reply_status
+
+        cell_name = f"cell_{self.shell.execution_count}"
+        with open(scorep_script_name, "w") as file:
+            file.write(self.pershelper.session_cell_wrapper(code, cell_name))
+        try:
+            self.session.bound_names.update(extract_bound_names(code))
+            self.session.codes.append(code)
+        except SyntaxError:
+            # Subprocess reports the error, nothing is bound
+            pass
+        script = self.session.run_script(scorep_script_name)
+        self.start_reading_scorep_process_streams(script, False)
+        if not self.session.is_alive():
+            self.log_error(KernelErrorCode.SCOREP_SUBPROCESS_FAIL)
+            self.abort_session()
+        return self.standard_reply()
+
+    async def start_session(
+        self, silent, user_expressions=None, allow_stdin=False, *, cell_id=None
+    ):
+        """
+        Start the session subprocess and load the notebook persistence into
+        it. Returns the reply if that failed, None otherwise.
+        """
+        self.log.info("Starting Score-P session...")
+        self.pershelper.set_dump_report_level()
+        self.pershelper.set_transfer_settings()
+        # Cells of the session might read any variable
+        self.pershelper.subprocess_read_names = None
+        self.pershelper.materialize(None, self.shell.user_ns)
+        self.pershelper.place_persistence(self.shell.user_ns)
+        if not self.pershelper.preprocess():
+            self.pershelper.postprocess()
+            self.log_error(KernelErrorCode.PERSISTENCE_SETUP_FAIL)
+            return self.standard_reply()
+        with open(scorep_script_name, "w") as file:
+            file.write(self.pershelper.session_load_wrapper())
+
+        if self.pershelper.mode == "disk":
+            reply_status_dump = await self.session_dump_ghost_cell(
+                silent, user_expressions, allow_stdin, cell_id=cell_id
+            )
+            if reply_status_dump is not None:
+                return reply_status_dump
+
+        # Standby process doesn't run cells of the session
+        self.standby.stop()
+        cmd, proc_env = self.scorep_launch_settings()
+        self.session = ScorepSession(
+            cmd, proc_env, self.pershelper, self.assign_experiment_directory()
+        )
+        script = self.session.run_script(scorep_script_name)
+
+        if self.pershelper.mode == "memory":
+            reply_status_dump = await self.session_dump_ghost_cell(
+                silent, user_expressions, allow_stdin, cell_id=cell_id
+            )
+            if reply_status_dump is not None:
+                self.abort_session()
+                return reply_status_dump
+
+        self.start_reading_scorep_process_streams(script, False)
+        if script.poll():
+            self.log_error(
+                KernelErrorCode.PERSISTENCE_LOAD_FAIL,
+                direction="Jupyter -> Score-P",
+                optional_hint=get_scorep_process_error_hint(),
+            )
+            self.abort_session()
+            return self.standard_reply()
+        return None
+
+    async def session_dump_ghost_cell(
+        self, silent, user_expressions=None, allow_stdin=False, *, cell_id=None
+    ):
+        """
+        Dump notebook persistence for the session subprocess. Returns the
+        reply if that failed, None otherwise.
+        """
+        reply_status_dump = await super().do_execute(
+            self.pershelper.jupyter_dump(),
+            silent,
+            store_history=False,
+            user_expressions=user_expressions,
+            allow_stdin=allow_stdin,
+            cell_id=cell_id,
+        )
+        if reply_status_dump["status"] != "ok":
+            self.log_error(
+                KernelErrorCode.PERSISTENCE_DUMP_FAIL,
+                direction="Jupyter -> Score-P",
+            )
+            self.pershelper.postprocess()
+            return reply_status_dump
+        return None
+
+    async def end_session(
+        self, silent, user_expressions=None, allow_stdin=False, *, cell_id=None
+    ):
+        """
+        Load variables bound by the cells of the session back into the
+        notebook and end the session subprocess.
+        """
+        session = self.session
+        if not session.is_alive():
+            self.log_error(KernelErrorCode.SCOREP_SUBPROCESS_FAIL)
+            self.abort_session()
+            return
+        self.log.info("Ending Score-P session...")
+        session_code = "\n".join(session.codes)
+        self.pershelper.parse(session_code, "subprocess")
+        with open(scorep_script_name, "w") as file:
+            file.write(self.pershelper.session_dump_wrapper())
+        script = session.run_script(scorep_script_name)
+        self.start_reading_scorep_process_streams(script, False)
+        if script.poll():
+            self.log_error(
+                KernelErrorCode.PERSISTENCE_DUMP_FAIL,
+                direction="Score-P -> Jupyter",
+            )
+            self.abort_session()
+            return
+
+        reply_status_update = await super().do_execute(
+            self.pershelper.jupyter_update(session_code),
+            silent,
+            store_history=False,
+            user_expressions=user_expressions,
+            allow_stdin=allow_stdin,
+            cell_id=cell_id,
+        )
+        if reply_status_update["status"] != "ok":
+            self.log_error(
+                KernelErrorCode.PERSISTENCE_LOAD_FAIL,
+                direction="Score-P -> Jupyter",
+                optional_hint=get_scorep_process_error_hint(),
+            )
+            self.abort_session()
+            return
+
+        session.close()
+        self.session = None
+        scorep_folder = self.report_experiment_directory(
+            session.proc, session.experiment_directory
+        )
+        self.pershelper.postprocess()
         if self.launch_vampir_requested and scorep_folder:
             self.try_launch_vampir(scorep_folder)
 
-        return self.standard_reply()
+    def abort_session(self):
+        """
+        End the session subprocess without loading its variables.
+        """
+        if self.session is not None:
+            self.session.proc.kill()
+            self.session.close()
+            self.session = None
+        self.pershelper.postprocess()
+
+    def report_experiment_directory(self, proc, assigned_directory):
+        """
+        Output the directory to which Score-P saved the measurement of the
+        subprocess. Returns it, "" if it's unknown.
+        """
+        if not assigned_directory:
+            scorep_folder = os.environ.get("SCOREP_EXPERIMENT_DIRECTORY", "")
+            self.log.debug(f"{scorep_folder=}")
+            self.cell_output(
+                f"Instrumentation results can be found in {scorep_folder}"
+            )
+            return scorep_folder
+        # Score-P writes the directory when the subprocess finalizes
+        proc.wait()
+        if os.path.isdir(assigned_directory):
+            self.cell_output(
+                f"Instrumentation results can be found in "
+                f"{os.path.join(os.getcwd(), assigned_directory)}"
+            )
+            return assigned_directory
+        # TODO: Directory isn't created local when running scorep-collector
+        self.cell_output(
+            "KernelWarning: Path of Instrumentation results could "
+            "not be determined or were not saved locally.",
+            "stderr",
+        )
+        return ""
+
+    def scorep_launch_settings(self):
+        """
+        Command (without the script) and environment of the instrumented
+        subprocess.
+        """
+        binding_args = self.scorep_binding_args
+        scorep_env = {
+            key: os.environ[key]
+            for key in os.environ
+            if key.startswith("SCOREP_")
+        }
+        proc_env = {
+            "PATH": os.environ.get("PATH", ""),
+            "LD_LIBRARY_PATH": os.environ.get("LD_LIBRARY_PATH", ""),
+            "PYTHONPATH": os.environ.get("PYTHONPATH", ""),
+            "EBPYTHONPREFIXES": os.environ.get("EBPYTHONPREFIXES", ""),
+            "PYTHONUNBUFFERED": "x",
+        }
+        proc_env.update(scorep_env)
+        # Bindings run the script directly with the cached preload
+        # environment instead of re-executing the interpreter with it
+        if self.pershelper.mode != "fork" and int(
+            os.getenv("SCOREP_JUPYTER_SINGLE_EXEC", "0")
+        ):
+            try:
+                proc_env.update(
+                    self.preload_environment.get(self.scorep_binding_args)
+                )
+                # Cached subsystem library must not be removed by the bindings
+                binding_args = binding_args + ["--keep-files"]
+            except Exception as e:
+                self.log.warning(f"Preload environment not cached: {e}")
+        cmd = [PYTHON_EXECUTABLE, "-m", "scorep"] + binding_args
+        self.log.debug(f"Subprocess command: {' '.join(cmd)}")
+        return cmd, proc_env
+
+    def assign_experiment_directory(self):
+        """
+        Unless set by the user, every run gets its own experiment directory
+        named like the ones Score-P creates, so it's known without searching
+        for it afterwards. Returns "" if set by the user.
+        """
+        if "SCOREP_EXPERIMENT_DIRECTORY" in os.environ:
+            return ""
+        return self.experiment_directory_name()
+
+    def spawn_standby_process(self):
+        """
+        Start the instrumented subprocess of the next cell in the background.
+        Not if the user set the experiment directory, which Score-P might
+        touch before the cell runs, even if the process is discarded.
+        """
+        if self.pershelper.mode == "fork" or not int(
+            os.getenv("SCOREP_JUPYTER_STANDBY_PROCESS", "0")
+        ):
+            return
+        assigned_directory = self.assign_experiment_directory()
+        if not assigned_directory:
+            return
+        cmd, proc_env = self.scorep_launch_settings()
+        self.start_standby_process(cmd, proc_env, assigned_directory)
+
+    def start_standby_process(self, cmd, proc_env, assigned_directory):
+        """
+        Start an instrumented subprocess waiting for a cell script. It loads
+        the current runtime of the notebook, which is returned, before it
+        imports the notebook modules.
+        """
+        runtime_prefix = standby_file_prefix()
+        runtime = self.pershelper.dump_standby_runtime(runtime_prefix)
+        self.standby.spawn(
+            cmd,
+            proc_env,
+            self.pershelper.standby_wrapper(runtime_prefix),
+            assigned_directory,
+            runtime,
+        )
+        return runtime
+
+    def experiment_directory_name(self):
+        """
+        Name of a new experiment directory in the working directory, unique
+        for the runs of all kernels.
+        """
+        self.experiment_count += 1
+        timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M")
+        return f"scorep-{timestamp}_{os.getpid()}_{self.experiment_count}"
 
     def start_reading_scorep_process_streams(
         self,
@@ -675,6 +1206,7 @@ class scorep_jupyterKernel(IPythonKernel):
         )  # Output parameter (return not possible from thread)
         t_stderr = threading.Thread(
             target=self.read_scorep_stderr,
+            name="scorep_stderr_reader",
             args=(
                 proc.stderr,
                 stdout_lock,
@@ -700,7 +1232,8 @@ class scorep_jupyterKernel(IPythonKernel):
         except KeyboardInterrupt:
             spinner_message = "Kernel interrupted."
         finally:
-            t_stderr.join()
+            with self.timeline.span("join_stderr_reader"):
+                t_stderr.join()
             process_busy_spinner.stop(spinner_message)
 
         # Handle recorded output
@@ -728,9 +1261,10 @@ class scorep_jupyterKernel(IPythonKernel):
             else:
                 captured_stdout.append(line)
 
-        self.read_scorep_stream(
-            stdout, lock, process_stdout_line, read_chunk_size
-        )
+        with self.timeline.span("read_stdout"):
+            self.read_scorep_stream(
+                stdout, lock, process_stdout_line, read_chunk_size
+            )
         return captured_stdout
 
     def read_scorep_stderr(
@@ -749,9 +1283,10 @@ class scorep_jupyterKernel(IPythonKernel):
             else:
                 captured_stderr.append(line)
 
-        self.read_scorep_stream(
-            stderr, lock, process_stderr_line, read_chunk_size
-        )
+        with self.timeline.span("read_stderr"):
+            self.read_scorep_stream(
+                stderr, lock, process_stderr_line, read_chunk_size
+            )
 
     def read_scorep_stream(
         self,
@@ -839,6 +1374,50 @@ class scorep_jupyterKernel(IPythonKernel):
         else save Score-P environment/binding arguments/ execute cell with
         Score-P Python binding.
         """
+        self.timeline.open(os.getenv("SCOREP_JUPYTER_KERNEL_TIMELINE"))
+        with self.timeline.span(
+            "do_execute", execution_count=self.shell.execution_count
+        ):
+            return await self.execute_cell(
+                code,
+                silent,
+                store_history,
+                user_expressions,
+                allow_stdin,
+                cell_id=cell_id,
+            )
+
+    def do_complete(self, code, cursor_pos):
+        """
+        Override of do_complete() method of IPythonKernel, completions of
+        lazily loaded variables need their values.
+        """
+        self.pershelper.materialize_identifiers(
+            code[:cursor_pos], self.shell.user_ns
+        )
+        return super().do_complete(code, cursor_pos)
+
+    def do_inspect(self, code, cursor_pos, *args, **kwargs):
+        """
+        Override of do_inspect() method of IPythonKernel, lazily loaded
+        variables are inspected with their values.
+        """
+        self.pershelper.materialize_identifiers(code, self.shell.user_ns)
+        return super().do_inspect(code, cursor_pos, *args, **kwargs)
+
+    async def execute_cell(
+        self,
+        code,
+        silent,
+        store_history=False,
+        user_expressions=None,
+        allow_stdin=False,
+        *,
+        cell_id=None,
+    ):
+        """
+        Dispatch the cell to its magic command handler or execute it.
+        """
         if code.startswith("%%scorep_python_binding_arguments"):
             return self.scorep_not_available() or self.set_scorep_pythonargs(
                 code
@@ -851,8 +1430,20 @@ class scorep_jupyterKernel(IPythonKernel):
             )
             return self.standard_reply()
         elif code.startswith("%%marshalling_settings"):
-            return self.scorep_not_available() or self.marshaller_settings(
-                code
+            scorep_missing = self.scorep_not_available()
+            if scorep_missing is None and self.session is not None:
+                # Session persistence was set up with the old settings
+                await self.end_session(
+                    silent, user_expressions, allow_stdin, cell_id=cell_id
+                )
+            return scorep_missing or self.marshaller_settings(code)
+        elif code.startswith("%%enable_scorep_session"):
+            return self.scorep_not_available() or self.enable_scorep_session()
+        elif code.startswith("%%disable_scorep_session"):
+            return self.scorep_not_available() or (
+                await self.disable_scorep_session(
+                    silent, user_expressions, allow_stdin, cell_id=cell_id
+                )
             )
         elif code.startswith("%%enable_multicellmode"):
             return self.scorep_not_available() or self.enable_multicellmode()
@@ -903,7 +1494,10 @@ class scorep_jupyterKernel(IPythonKernel):
             if shutil.which("vampir") is None:
                 self.log_error(KernelErrorCode.VAMPIR_NOT_FOUND)
             else:
-                self.cell_output("Vampir will be launched after next instrumented execution.")
+                self.cell_output(
+                    "Vampir will be launched after next instrumented "
+                    "execution."
+                )
             return self.standard_reply()
         elif code.startswith("%%disable_vampir_launch"):
             self.launch_vampir_requested = False
@@ -912,7 +1506,38 @@ class scorep_jupyterKernel(IPythonKernel):
         elif code.startswith("%%execute_with_scorep"):
             scorep_missing = self.scorep_not_available()
             if scorep_missing is None:
-                if self.mode == KernelMode.DEFAULT:
+                try:
+                    repetitions = parse_repetitions(code.split("\n", 1)[0])
+                except ValueError as e:
+                    self.cell_output(
+                        f"KernelWarning: {e}, cell not executed.", "stderr"
+                    )
+                    return self.standard_reply()
+                if self.mode != KernelMode.DEFAULT and repetitions:
+                    self.cell_output(
+                        f"KernelWarning: Currently in {self.mode}, "
+                        "command ignored.",
+                        "stderr",
+                    )
+                    return self.standard_reply()
+                elif repetitions:
+                    return await self.repeat_execute(
+                        code.split("\n", 1)[1],
+                        repetitions,
+                        silent,
+                        user_expressions,
+                        allow_stdin,
+                        cell_id=cell_id,
+                    )
+                elif self.mode == KernelMode.DEFAULT and self.session_enabled:
+                    return await self.session_execute(
+                        code.split("\n", 1)[1],
+                        silent,
+                        user_expressions,
+                        allow_stdin,
+                        cell_id=cell_id,
+                    )
+                elif self.mode == KernelMode.DEFAULT:
                     return await self.scorep_execute(
                         code.split("\n", 1)[1],
                         silent,
@@ -937,7 +1562,27 @@ class scorep_jupyterKernel(IPythonKernel):
                 return scorep_missing
         else:
             if self.mode == KernelMode.DEFAULT:
-                self.pershelper.parse(magics_cleanup(code)[1], "jupyter")
+                if (
+                    self.session is not None
+                    and self.pershelper.session_needs_sync(
+                        code, self.session.bound_names, self.shell.user_ns
+                    )
+                ):
+                    with self.timeline.span("end_session"):
+                        await self.end_session(
+                            silent,
+                            user_expressions,
+                            allow_stdin,
+                            cell_id=cell_id,
+                        )
+                with self.timeline.span("parse"):
+                    self.pershelper.materialize(code, self.shell.user_ns)
+                    # Evaluated in the namespace after the cell
+                    for expression in (user_expressions or {}).values():
+                        self.pershelper.materialize_identifiers(
+                            expression, self.shell.user_ns
+                        )
+                    self.pershelper.parse(magics_cleanup(code)[1], "jupyter")
                 parent_ret = await super().do_execute(
                     code,
                     silent,
@@ -958,7 +1603,13 @@ class scorep_jupyterKernel(IPythonKernel):
                 )
 
     def do_shutdown(self, restart):
-        self.pershelper.postprocess()
+        self.pershelper.shutdown()
+        self.preload_environment.clear()
+        self.standby.stop()
+        remove_standby_scripts()
+        if self.session is not None:
+            self.session.close()
+        self.timeline.close()
         return super().do_shutdown(restart)
 
     def log_error(self, code: KernelErrorCode, **kwargs):
@@ -0,0 +1,118 @@
+import contextlib
+import datetime
+import json
+import os
+import threading
+import time
+
+# Returned by spans of a timeline that isn't recorded
+null_span = contextlib.nullcontext()
+
+
+class KernelTimeline:
+    """
+    Spans of the kernel's own work, e.g. ghost cells or reading subprocess
+    streams, written to a Chrome trace file (JSON array format, opens in
+    Perfetto and chrome://tracing). Events are appended as they end, so
+    the file is usable while the kernel runs. Nothing is recorded until
+    open() is called with a directory.
+    """
+
+    def __init__(self):
+        self.file = None
+        self.path = ""
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+        self.named_threads = set()
+
+    def open(self, directory):
+        """
+        Start the timeline of the session in the directory, if not yet done.
+        """
+        if self.file is not None or not directory:
+            return
+        os.makedirs(directory, exist_ok=True)
+        timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+        self.path = os.path.join(
+            directory, f"scorep_jupyter_timeline_{timestamp}_{self.pid}.json"
+        )
+        self.file = open(self.path, "w")
+        self.file.write("[\n")
+        self.write_event(
+            {
+                "name": "process_name",
+                "ph": "M",
+                "pid": self.pid,
+                "args": {"name": "scorep_jupyter kernel"},
+            }
+        )
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+    def span(self, name, **args):
+        """
+        Context manager recording a span of the current thread.
+        """
+        if self.file is None:
+            return null_span
+        return self.record_span(name, args)
+
+    @contextlib.contextmanager
+    def record_span(self, name, args):
+        started_span = self.begin(name, **args)
+        try:
+            yield
+        finally:
+            self.end(started_span)
+
+    def begin(self, name, **args):
+        """
+        Start a span of the current thread, finished by end().
+        """
+        if self.file is None:
+            return None
+        return name, args, time.perf_counter_ns()
+
+    def end(self, started_span, name=None):
+        """
+        Finish a span started by begin(), the name may be set only now.
+        """
+        if started_span is None:
+            return
+        begin_name, args, start = started_span
+        name = name or begin_name
+        end = time.perf_counter_ns()
+        thread = threading.current_thread()
+        if thread.ident not in self.named_threads:
+            self.named_threads.add(thread.ident)
+            self.write_event(
+                {
+                    "name": "thread_name",
+                    "ph": "M",
+                    "pid": self.pid,
+                    "tid": thread.ident,
+                    "args": {"name": thread.name},
+                }
+            )
+        event = {
+            "name": name,
+            "ph": "X",
+            "ts": start / 1000,
+            "dur": (end - start) / 1000,
+            "pid": self.pid,
+            "tid": thread.ident,
+        }
+        if args:
+            event["args"] = args
+        self.write_event(event)
+
+    def write_event(self, event):
+        # Closing bracket of the array is optional for trace viewers
+        with self.lock:
+            if self.file is not None:
+                self.file.write(json.dumps(event) + ",\n")
+                self.file.flush()
@@ -0,0 +1,119 @@
+import json
+import os
+import time
+
+phase_report_name = "scorep_jupyter_phase_report.json"
+# Phases of an instrumented cell in the order they are reported
+phases = (
+    "preprocess",
+    "jupyter_dump",
+    "startup",
+    "load_runtime",
+    "load_variables",
+    "cell",
+    "dump",
+    "jupyter_update",
+    "experiment_directory",
+)
+
+# Bytes written by dumps of the ghost cell, which runs in the kernel process
+ghost_cell_transfer = {"bytes": 0}
+
+
+class CountingFile:
+    """
+    Wrapper of a file counting bytes written to it, other attributes are
+    those of the file.
+    """
+
+    def __init__(self, file):
+        self.file = file
+        self.size = 0
+
+    def write(self, data):
+        with memoryview(data) as view:
+            self.size += view.nbytes
+        return self.file.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self.file, name)
+
+
+def record_transfer(size):
+    """
+    Count bytes dumped by the ghost cell, returns them.
+    """
+    ghost_cell_transfer["bytes"] += size
+    return size
+
+
+def write_subprocess_report(timestamps, transfer_bytes):
+    """
+    Pass end times of the phases of the subprocess and bytes it dumped to
+    the kernel.
+    """
+    with open(phase_report_name, "w") as file:
+        json.dump({"timestamps": timestamps, "bytes": transfer_bytes}, file)
+
+
+class PhaseReport:
+    """
+    Durations of the phases of an instrumented cell and bytes transferred
+    in either direction. Phases measured by the kernel are also recorded
+    as spans of the timeline, if given.
+    """
+
+    def __init__(self, timeline=None):
+        self.durations = {}
+        self.transfer_bytes = {}
+        self.phase_start = time.time()
+        self.timeline = timeline
+        self.timeline_span = None
+
+    def start(self):
+        self.phase_start = time.time()
+        if self.timeline is not None:
+            self.timeline_span = self.timeline.begin("phase")
+
+    def stop(self, phase):
+        self.durations[phase] = time.time() - self.phase_start
+        if self.timeline is not None:
+            self.timeline.end(self.timeline_span, phase)
+            self.timeline_span = None
+
+    def start_ghost_cell(self):
+        ghost_cell_transfer["bytes"] = 0
+        self.start()
+
+    def stop_ghost_cell(self, phase, direction):
+        self.stop(phase)
+        self.transfer_bytes[direction] = ghost_cell_transfer["bytes"]
+
+    def add_subprocess_report(self, launch_time, direction):
+        """
+        Add phases measured by the subprocess launched at launch_time, wall
+        clock time is compared between the processes.
+        """
+        if not os.path.exists(phase_report_name):
+            return
+        with open(phase_report_name, "r") as file:
+            report = json.load(file)
+        phase_start = launch_time
+        for phase, end_time in report["timestamps"]:
+            self.durations[phase] = end_time - phase_start
+            phase_start = end_time
+        self.transfer_bytes[direction] = report["bytes"]
+
+    def to_json(self):
+        return json.dumps(
+            {"phases": self.durations, "bytes": self.transfer_bytes}
+        )
+
+    def to_text(self):
+        lines = ["Phases of the instrumented cell:"]
+        for phase in phases:
+            if phase in self.durations:
+                lines.append(f"  {phase:<22}{self.durations[phase]:10.3f} s")
+        for direction, size in self.transfer_bytes.items():
+            lines.append(f"  {direction:<22}{size / 1024 ** 2:10.3f} MiB")
+        return "\n".join(lines)
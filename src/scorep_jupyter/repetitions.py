@@ -0,0 +1,33 @@
+import re
+
+repeat_option = re.compile(r"--repeat(?![\w-])(?:[= ]+(\S+))?")
+
+
+def parse_repetitions(magic_line):
+    """
+    Number of repetitions requested by the --repeat option of the magic
+    line, None without it. Raises ValueError unless it's a positive integer.
+    """
+    match = repeat_option.search(magic_line)
+    if match is None:
+        return None
+    value = match.group(1)
+    if value is None or not re.fullmatch(r"[1-9][0-9]*", value):
+        raise ValueError(
+            f"--repeat needs a positive number of repetitions, got {value!r}"
+        )
+    return int(value)
+
+
+def repetition_runs(repetitions, configured_directory, assign_directory):
+    """
+    Yield number, experiment directory and whether to dump persistence for
+    every repetition. Directories are assigned by assign_directory(),
+    unless the user set one, which is then numbered per repetition. Only
+    the final repetition dumps, its variables are loaded into the notebook.
+    """
+    for repetition in range(1, repetitions + 1):
+        directory = assign_directory() or (
+            f"{configured_directory}_{repetition}"
+        )
+        yield repetition, directory, repetition == repetitions
@@ -0,0 +1,118 @@
+import os
+import uuid
+
+from scorep_jupyter.standby_process import StandbyProcess
+
+
+class SessionStream:
+    """
+    Output stream of the session subprocess, read script by script. A
+    script's output ends where the subprocess marks the end of the script,
+    the exit status of the script follows the marker.
+    """
+
+    def __init__(self, stream, marker):
+        self.stream = stream
+        self.marker = marker
+        self.buffer = b""
+        self.status = None
+
+    def start_script(self):
+        self.status = None
+
+    def read(self, size=-1):
+        size = size if size > 0 else 65536
+        while self.status is None:
+            index = self.buffer.find(self.marker)
+            if index > 0:
+                data, self.buffer = self.buffer[:index], self.buffer[index:]
+                return data
+            elif index == 0:
+                line, newline, rest = self.buffer.partition(b"\n")
+                if newline:
+                    self.status = int(line.replace(self.marker, b""))
+                    self.buffer = rest
+                    return b""
+            else:
+                # Keep the end of the buffer, the marker might start there
+                safe_size = len(self.buffer) - len(self.marker) + 1
+                if safe_size > 0:
+                    data = self.buffer[:safe_size]
+                    self.buffer = self.buffer[safe_size:]
+                    return data
+            chunk = self.stream.read1(size)
+            if not chunk:
+                # Subprocess exited within the script
+                self.status = 1
+                return self.buffer
+            self.buffer += chunk
+        return b""
+
+
+class SessionScript:
+    """
+    Counterpart of subprocess.Popen for a script run by the session
+    subprocess, the return code is the exit status of the script.
+    """
+
+    def __init__(self, pid, stdout, stderr):
+        self.pid = pid
+        self.stdout = stdout
+        self.stderr = stderr
+        self.stdout.start_script()
+        self.stderr.start_script()
+
+    def poll(self):
+        return self.stdout.status
+
+    def wait(self):
+        # Output is read until the end of the script, so it's finished
+        return self.stdout.status
+
+
+class ScorepSession:
+    """
+    Instrumented subprocess kept alive across consecutive instrumented
+    cells, which run in its own namespace. Variables are loaded from the
+    kernel when it starts, and dumped back when the session ends.
+    """
+
+    def __init__(self, cmd, proc_env, pershelper, experiment_directory):
+        self.marker = f"\0scorep_jupyter_session_{uuid.uuid4().hex}:"
+        standby = StandbyProcess()
+        standby.spawn(
+            cmd,
+            proc_env,
+            pershelper.session_wrapper(self.marker),
+            experiment_directory,
+        )
+        self.proc, self.experiment_directory = standby.take(cmd, proc_env)
+        self.stdout = SessionStream(self.proc.stdout, self.marker.encode())
+        self.stderr = SessionStream(self.proc.stderr, self.marker.encode())
+        # Code of the instrumented cells run in the session
+        self.codes = []
+        # Names bound by these cells
+        self.bound_names = set()
+
+    def run_script(self, script_path):
+        """
+        Let the session subprocess run the script, returns its SessionScript.
+        """
+        script = SessionScript(self.proc.pid, self.stdout, self.stderr)
+        self.proc.stdin.write(f"{os.path.abspath(script_path)}\n".encode())
+        self.proc.stdin.flush()
+        return script
+
+    def is_alive(self):
+        return self.proc.poll() is None
+
+    def close(self):
+        """
+        End the session subprocess, Score-P writes the measurement then.
+        Returns its exit code.
+        """
+        self.proc.stdin.close()
+        returncode = self.proc.wait()
+        self.proc.stdout.close()
+        self.proc.stderr.close()
+        return returncode
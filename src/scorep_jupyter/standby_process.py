@@ -0,0 +1,137 @@
+import glob
+import os
+import shutil
+import subprocess
+import threading
+import uuid
+
+# Files of standby processes, each removes its own ones when it starts
+standby_script_prefix = "scorep_standby_"
+
+
+def standby_file_prefix():
+    """
+    Unique prefix of the files of a new standby process.
+    """
+    return f"{standby_script_prefix}{uuid.uuid4().hex}"
+
+
+def environment_key(cmd, proc_env, runtime=None):
+    key = tuple(cmd), tuple(sorted(proc_env.items()))
+    if runtime is None:
+        return key
+    os_environ_, sys_path_ = runtime
+    return key + (tuple(sorted(os_environ_.items())), tuple(sys_path_))
+
+
+class StandbyProcess:
+    """
+    Instrumented subprocess started ahead of the cell it runs. It loads the
+    runtime environment and sys.path of the notebook, imports the
+    persistence and notebook modules, then waits for the path of the cell
+    script on its stdin. Recording is switched off until then. It's only
+    used for a cell launched with the same command, environment and
+    notebook runtime.
+    """
+
+    def __init__(self):
+        self.proc = None
+        self.key = None
+        self.experiment_directory = ""
+
+    def spawn(
+        self,
+        cmd,
+        proc_env,
+        standby_code,
+        experiment_directory="",
+        runtime=None,
+    ):
+        """
+        Start a standby process, replacing the current one. The experiment
+        directory, if given, is set in its environment. The runtime, if
+        given, is the environment and sys.path of the notebook loaded by the
+        standby code.
+        """
+        self.stop()
+        script_path = f"{standby_file_prefix()}.py"
+        with open(script_path, "w") as file:
+            file.write(standby_code)
+        env = dict(proc_env)
+        if experiment_directory:
+            env["SCOREP_EXPERIMENT_DIRECTORY"] = experiment_directory
+        self.proc = subprocess.Popen(
+            cmd + [script_path],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            env=env,
+        )
+        self.key = environment_key(cmd, proc_env, runtime)
+        self.experiment_directory = experiment_directory
+
+    def take(self, cmd, proc_env, runtime=None):
+        """
+        Hand the standby process over if it's running with the command,
+        environment and runtime. Returns it and its assigned experiment
+        directory, or None and "" if there is no such process.
+        """
+        proc = self.proc
+        if (
+            proc is None
+            or proc.poll() is not None
+            or self.key != environment_key(cmd, proc_env, runtime)
+        ):
+            self.stop()
+            return None, ""
+        self.proc = None
+        self.key = None
+        return proc, self.experiment_directory
+
+    def stop(self):
+        """
+        Let the standby process exit without running a script. It exits
+        without finalizing Score-P, its assigned experiment directory is
+        removed in case Score-P created it already. It's waited for in the
+        background.
+        """
+        if self.proc is not None:
+            experiment_directory = self.experiment_directory
+            if experiment_directory:
+                experiment_directory = os.path.abspath(experiment_directory)
+            threading.Thread(
+                target=reap_process,
+                args=(self.proc, 5, experiment_directory),
+                name="scorep_standby_reaper",
+                daemon=True,
+            ).start()
+        self.proc = None
+        self.key = None
+        self.experiment_directory = ""
+
+
+def reap_process(proc, timeout=5, experiment_directory=""):
+    """
+    Close stdin of the process and wait for it, reading its output. The
+    experiment directory, if given, is removed afterwards.
+    """
+    try:
+        proc.communicate(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.communicate()
+    if experiment_directory:
+        shutil.rmtree(experiment_directory, ignore_errors=True)
+
+
+def run_script(proc, script_path):
+    """
+    Let a standby process run the script.
+    """
+    proc.stdin.write(f"{os.path.abspath(script_path)}\n".encode())
+    proc.stdin.close()
+
+
+def remove_standby_scripts():
+    for path in glob.glob(f"{standby_script_prefix}*"):
+        os.remove(path)
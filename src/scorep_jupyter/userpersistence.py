@@ -1,18 +1,61 @@
 import os
+import re
 import shutil
 import ast
+import builtins
+import gc
+import io
+import json
+import pickle
+import struct
+import tempfile
 import threading
 import time
 import sys
 import types
+import zlib
 
 import astunparse
 from pathlib import Path
 import uuid
 import importlib
 
+from scorep_jupyter.phase_report import CountingFile, phase_report_name
 
 scorep_script_name = "scorep_script.py"
+delta_manifest_name = "manifest.json"
+# Marshallers whose dumps can only be loaded once
+single_use_marshallers = ("parallel_marshall", "shm_marshall")
+
+# Values of these types can't change without rebinding the name, so
+# identity alone tells whether they need to be transferred again.
+immutable_types = (
+    int,
+    float,
+    complex,
+    bool,
+    str,
+    bytes,
+    range,
+    type(None),
+)
+# Builtins that access the notebook namespace dynamically. Cells using them
+# can touch any variable, so change tracking and name analysis give up.
+dynamic_namespace_builtins = {"eval", "exec", "globals", "locals", "vars"}
+# Upper bound of objects visited when looking for notebook functions reachable
+# from the variables read by a cell, above that all variables are transferred
+read_set_max_objects = 1000000
+# Names in code that might not parse, e.g. while it's being completed
+identifier_pattern = re.compile(r"[^\W\d]\w*")
+# Header of a variable record in streamed transfers: lengths of the name and
+# of the serialized value
+stream_record_header = struct.Struct(">IQ")
+# Prefix of Score-P user regions around the phases of the subprocess script
+phase_region_prefix = "scorep_jupyter:"
+# Free space required for automatically placed disk mode persistence, as a
+# multiple of the estimated size of the notebook variables (they are dumped
+# by the kernel and the subprocess might dump as much back)
+placement_space_factor = 2
 
 
 class PersHelper:
@@ -26,16 +69,39 @@ class PersHelper:
         self.base_path = Path(
             os.environ["SCOREP_JUPYTER_PERSISTENCE_DIR"]
         ) / Path("./kernel_persistence/")
+        # "auto" places disk mode persistence in RAM-backed or node-local
+        # directories, "configured" in SCOREP_JUPYTER_PERSISTENCE_DIR
+        self.persistence_placement = "auto"
+        # Bytes of the last dump of the notebook, estimates the size of the
+        # next one for the placement
+        self.transfer_size = None
         self.paths = {
             "jupyter": {"os_environ": "", "sys_path": "", "var": ""},
             "subprocess": {"os_environ": "", "sys_path": "", "var": ""},
         }
         self.is_dump_detailed_report = False
+        # "text" or "json" report of the phases of instrumented cells
+        self.phase_report_format = ""
+        self.is_delta_transfer = False
+        self.is_read_set_transfer = False
+        self.is_streaming_transfer = False
+        self.is_lazy_loading = False
+        self.is_lazy_faulting = False
+        self.is_persistence_traced = False
+        self.is_phase_regions = False
+        # Names of variables loaded from the subprocess which might still be
+        # LazyVariable placeholders in the notebook namespace
+        self.lazy_variables = set()
+        # Names read by the subprocess code, None if they can't be determined
+        self.subprocess_read_names = None
+        self.delta_cache_path = Path(
+            os.environ["SCOREP_JUPYTER_PERSISTENCE_DIR"]
+        ) / Path("./kernel_persistence_cache/")
 
     def preprocess(self):
 
         uid = str(uuid.uuid4())
-        if self.mode == "disk":
+        if self.mode in ("disk", "fork"):
             os.makedirs(self.base_path)
 
         fd_path = ""
@@ -47,13 +113,21 @@ class PersHelper:
                     fd_path = "scorep_jupyter_" + key1 + "_" + key2 + "_" + uid
                 elif self.mode == "disk":
                     fd_path = dir_path + "_" + key2 + "_" + uid
+                elif self.mode == "fork":
+                    # Forked process inherits notebook namespace, only
+                    # its persistence is transmitted back
+                    fd_path = (
+                        dir_path + "_" + key2 + "_" + uid
+                        if key1 == "subprocess"
+                        else ""
+                    )
 
                 self.paths[key1][key2] = fd_path
 
                 try:
                     if self.mode == "memory":
                         os.mkfifo(fd_path)
-                    elif self.mode == "disk":
+                    elif self.mode == "disk" or fd_path:
                         open(fd_path, "a").close()
                 except PermissionError:
                     print(
@@ -75,18 +149,46 @@ class PersHelper:
         """
         Clean up files used for transmitting persistence and running subprocess
         """
+        # Marshallers might keep data outside of the files/pipes, e.g.
+        # shared memory segments of an interrupted transfer
+        marshaller_module = importlib.import_module(self.marshaller)
+        if hasattr(marshaller_module, "cleanup"):
+            for key1 in self.paths:
+                for key2 in self.paths[key1]:
+                    if self.paths[key1][key2]:
+                        marshaller_module.cleanup(self.paths[key1][key2])
+
         if self.mode == "memory":
             for key1 in self.paths:
                 for key2 in self.paths[key1]:
                     fd_path = self.paths[key1][key2]
                     if os.path.exists(fd_path):
                         os.unlink(fd_path)
-        elif self.mode == "disk":
+        elif self.mode in ("disk", "fork"):
             if os.path.exists(str(self.base_path)):
                 shutil.rmtree(str(self.base_path))
 
         if os.path.exists(scorep_script_name):
             os.remove(scorep_script_name)
+        if os.path.exists(phase_report_name):
+            os.remove(phase_report_name)
+
+    def shutdown(self):
+        """
+        Clean up everything kept across cells, called when kernel shuts down
+        """
+        self.postprocess()
+        self.shutdown_marshaller()
+        if os.path.exists(str(self.delta_cache_path)):
+            shutil.rmtree(str(self.delta_cache_path))
+
+    def shutdown_marshaller(self):
+        """
+        Release resources marshallers keep across cells, e.g. worker pools
+        """
+        marshaller_module = importlib.import_module(self.marshaller)
+        if hasattr(marshaller_module, "shutdown"):
+            marshaller_module.shutdown()
 
     def set_marshaller(self, marshaller):
         try:
@@ -97,10 +199,14 @@ class PersHelper:
             marshaller_module, "load"
         ):
             return False
+        if marshaller != self.marshaller:
+            self.shutdown_marshaller()
         return setattr(self, "marshaller", marshaller) or True
 
     def set_mode(self, mode):
         valid_modes = {"disk", "memory"}
+        if hasattr(os, "fork"):
+            valid_modes.add("fork")
         return mode in valid_modes and (setattr(self, "mode", mode) or True)
 
     def jupyter_dump(self):
@@ -115,7 +221,10 @@ class PersHelper:
             "import threading\n"
             f"import {self.marshaller}\n"
             "from scorep_jupyter.userpersistence import dump_runtime, "
-            "dump_variables, create_busy_spinner\n"
+            "dump_variables, dump_variables_delta, dump_variables_records, "
+            "dump_variables_stream, resolve_read_variables, "
+            "create_busy_spinner\n"
+            "from scorep_jupyter.phase_report import record_transfer\n"
             "spinner = create_busy_spinner()\n"
             f"if {self.is_dump_detailed_report}:\n"
             "    spinner.start('Dumping runtime environment and sys.path...')"
@@ -123,16 +232,14 @@ class PersHelper:
             f"else:\n"
             "    spinner.start('Loading data...')\n"
             "try:\n"
-            "    dump_runtime(os.environ, sys.path,"
+            "    record_transfer(dump_runtime(os.environ, sys.path,"
             f"    '{self.paths['jupyter']['os_environ']}',"
-            f"    '{self.paths['jupyter']['sys_path']}',{self.marshaller})\n"
+            f"    '{self.paths['jupyter']['sys_path']}',{self.marshaller}))\n"
             f"    if {self.is_dump_detailed_report}:\n"
             "        spinner.report('Dumping runtime environment and "
             "sys.path done.')\n"
             "        spinner.start('Dumping variables...')\n"
-            f"    dump_variables({str(self.jupyter_variables)},globals(),"
-            f"        '{self.paths['jupyter']['var']}',"
-            f"        {self.marshaller})\n"
+            f"    record_transfer({self.dump_variables_call()})\n"
             f"    if {self.is_dump_detailed_report}:\n"
             "        spinner.stop('Dumping variables done.')\n"
             f"    else:\n"
@@ -143,25 +250,99 @@ class PersHelper:
 
         return jupyter_dump_
 
-    def subprocess_wrapper(self, code):
+    def dump_variables_call(self):
+        """
+        Generate call dumping notebook variables in jupyter_dump ghost cell.
+        """
+        variables_names = str(self.jupyter_variables)
+        if self.subprocess_read_names is not None:
+            variables_names = (
+                f"resolve_read_variables("
+                f"{sorted(self.subprocess_read_names)},"
+                f"{variables_names},globals())"
+            )
+        if self.is_delta_transfer:
+            return (
+                f"dump_variables_delta({variables_names},"
+                f"globals(),'{self.paths['jupyter']['var']}',"
+                f"{self.marshaller},'{self.delta_cache_path}')"
+            )
+        return (
+            f"{self.dump_function('jupyter')}({variables_names},globals(),"
+            f"'{self.paths['jupyter']['var']}',{self.marshaller})"
+        )
+
+    def is_records_transfer(self, direction):
+        """
+        Whether variables dumped by the side ("jupyter" or "subprocess")
+        are sent as separately serialized records, which the receiving
+        side keeps to deserialize them lazily.
+        """
+        if direction == "jupyter":
+            return self.is_lazy_faulting
+        return self.is_lazy_loading
+
+    def dump_function(self, direction):
+        """
+        Name of the function dumping variables of the side, except for
+        delta transfers.
+        """
+        if self.is_records_transfer(direction):
+            return "dump_variables_records"
+        elif self.is_streaming_transfer:
+            return "dump_variables_stream"
+        return "dump_variables"
+
+    def load_function(self, direction):
         """
-        Extract subprocess user variables and definitions.
+        Name of the function loading variables dumped by the side, except
+        for delta transfers.
+        """
+        if self.is_records_transfer(direction):
+            return "load_variables_records"
+        elif self.is_streaming_transfer:
+            return "load_variables_stream"
+        return "load_variables"
+
+    def subprocess_wrapper(self, code, cell_name="cell"):
+        """
+        Extract subprocess user variables and definitions. The cell code is
+        recorded as a user region named after cell_name.
         """
         self.parse(code, "subprocess")
-        subprocess_code = (
-            "import sys\n"
-            "import os\n"
-            f"import {self.marshaller}\n"
-            "from scorep_jupyter.userpersistence import dump_runtime,"
-            "dump_variables, load_runtime, load_variables\n"
+        read_names = extract_read_names(code)
+        self.subprocess_read_names = (
+            read_names if self.is_read_set_transfer else None
+        )
+        subprocess_code = self.subprocess_imports()
+        subprocess_code += self.persistence_phase(
+            "load_runtime",
             "load_runtime(os.environ, sys.path,"
             f"'{self.paths['jupyter']['os_environ']}',"
-            f"'{self.paths['jupyter']['sys_path']}',{self.marshaller})\n"
-            f"{self.jupyter_definitions}"
-            f"load_variables(globals(),'{self.paths['jupyter']['var']}',"
-            f"{self.marshaller})\n"
-            f"{code}\n"
+            f"'{self.paths['jupyter']['sys_path']}',{self.marshaller})\n",
         )
+        # Code looking up variables dynamically might miss variables which
+        # aren't deserialized yet
+        namespace = "globals()"
+        if self.is_lazy_faulting and read_names is not None:
+            namespace = "namespace_"
+            subprocess_code += self.persistence_phase(
+                "load_variables",
+                "namespace_ = load_variables_faulting(globals(),"
+                f"{repr(self.jupyter_definitions)},"
+                f"'{self.paths['jupyter']['var']}',{self.marshaller})\n",
+            )
+            subprocess_code += self.cell_phase(
+                cell_name, f"{code}\n", "namespace_"
+            )
+        else:
+            subprocess_code += (
+                f"{self.jupyter_definitions}"
+                + self.persistence_phase(
+                    "load_variables", self.load_variables_call()
+                )
+                + self.cell_phase(cell_name, f"{code}\n")
+            )
 
         # In memory mode, signal subprocess output observer in kernel to
         # terminate by closing the streams
@@ -174,17 +355,315 @@ class PersHelper:
                 "os.close(sys.stderr.fileno())\n"
             )
 
-        subprocess_code += (
+        subprocess_code += self.persistence_phase(
+            "dump",
+            "transfer_bytes_ = dump_runtime(os.environ, sys.path,"
+            f"'{self.paths['subprocess']['os_environ']}',"
+            f"'{self.paths['subprocess']['sys_path']}',"
+            f"{self.marshaller})\n"
+            f"transfer_bytes_ += {self.dump_function('subprocess')}("
+            f"{str(self.subprocess_variables)},"
+            f"{namespace},'{self.paths['subprocess']['var']}',"
+            f"{self.marshaller})\n",
+        )
+        if self.phase_report_format:
+            subprocess_code += (
+                "write_subprocess_report(timestamps_, transfer_bytes_)\n"
+            )
+
+        return subprocess_code
+
+    def subprocess_imports(self):
+        """
+        Imports of the persistence code of the subprocess.
+        """
+        imports = (
+            "import sys\n"
+            "import os\n"
+            f"import {self.marshaller}\n"
+            "from scorep_jupyter.userpersistence import dump_runtime,"
+            "dump_variables, dump_variables_records, dump_variables_stream, "
+            "load_runtime, load_variables, load_variables_delta, "
+            "load_variables_faulting, load_variables_records, "
+            "load_variables_stream\n"
+        )
+        if not self.is_persistence_traced:
+            imports += "import scorep.instrumenter\n"
+        if self.is_phase_regions:
+            imports += "import scorep.user\n"
+        if self.phase_report_format:
+            imports += (
+                "import time\n"
+                "from scorep_jupyter.phase_report import "
+                "write_subprocess_report\n"
+                "timestamps_ = [('startup', time.time())]\n"
+            )
+        return imports
+
+    def session_wrapper(self, marker):
+        """
+        Code of a session subprocess, which runs the scripts whose paths it
+        reads from stdin in one namespace until stdin is closed. The end of
+        each script is marked on stdout and stderr by the marker followed by
+        the exit status of the script, scripts may mark it earlier by
+        calling end_script_().
+        """
+        return (
+            "import os\n"
+            "import sys\n"
+            "import traceback\n"
+            "import scorep.instrumenter\n"
+            "os.remove(__file__)\n"
+            "def end_script_(status):\n"
+            "    ended_.append(status)\n"
+            "    for stream_ in (sys.stdout, sys.stderr):\n"
+            f"        stream_.write({marker!r} + str(status) + '\\n')\n"
+            "        stream_.flush()\n"
+            "session_globals_ = {'__name__': '__main__', "
+            "'end_script_': end_script_}\n"
+            "while True:\n"
+            "    with scorep.instrumenter.disable():\n"
+            "        script_path_ = sys.stdin.readline().strip()\n"
+            "    if not script_path_:\n"
+            "        break\n"
+            "    with open(script_path_) as file_:\n"
+            "        code_ = file_.read()\n"
+            "    ended_ = []\n"
+            "    session_globals_['__file__'] = script_path_\n"
+            "    try:\n"
+            "        exec(compile(code_, script_path_, 'exec'), "
+            "session_globals_)\n"
+            "        status_ = 0\n"
+            "    except BaseException:\n"
+            "        traceback.print_exc()\n"
+            "        status_ = 1\n"
+            "    if not ended_:\n"
+            "        end_script_(status_)\n"
+        )
+
+    def session_load_wrapper(self):
+        """
+        Script of the session subprocess loading the notebook state.
+        """
+        return (
+            self.subprocess_imports()
+            + self.persistence_phase(
+                "load_runtime",
+                "load_runtime(os.environ, sys.path,"
+                f"'{self.paths['jupyter']['os_environ']}',"
+                f"'{self.paths['jupyter']['sys_path']}',{self.marshaller})\n",
+            )
+            + self.jupyter_definitions
+            + self.persistence_phase(
+                "load_variables", self.load_variables_call()
+            )
+        )
+
+    def session_cell_wrapper(self, code, cell_name):
+        """
+        Script of the session subprocess running an instrumented cell.
+        """
+        return self.cell_phase(cell_name, f"{code}\n")
+
+    def session_dump_wrapper(self):
+        """
+        Script of the session subprocess dumping the variables written by
+        its cells (parsed as subprocess code) back to the kernel.
+        """
+        session_code = self.subprocess_imports()
+        # In memory mode the kernel loads concurrently to the dump
+        if self.mode == "memory":
+            session_code += "end_script_(0)\n"
+        return session_code + self.persistence_phase(
+            "dump",
             "dump_runtime(os.environ, sys.path,"
             f"'{self.paths['subprocess']['os_environ']}',"
             f"'{self.paths['subprocess']['sys_path']}',"
             f"{self.marshaller})\n"
-            f"dump_variables({str(self.subprocess_variables)},"
+            f"{self.dump_function('subprocess')}("
+            f"{str(self.subprocess_variables)},"
             f"globals(),'{self.paths['subprocess']['var']}',"
-            f"{self.marshaller})\n"
+            f"{self.marshaller})\n",
         )
 
-        return subprocess_code
+    def session_needs_sync(self, code, session_names, globals_):
+        """
+        Whether the notebook cell needs the state of the session
+        subprocess: it might read names bound by the session cells, or it
+        binds names the session wouldn't see. Reading a notebook variable
+        the session holds ends it as well, since the cell might modify it
+        in place (e.g. lst.append()) and the session keeps its own copy.
+        """
+        if any(
+            line.strip().startswith(("%", "!")) for line in code.splitlines()
+        ):
+            return True
+        try:
+            read_names = extract_read_names(code)
+            bound_names = extract_bound_names(code)
+        except SyntaxError:
+            return True
+        if read_names is None or bound_names or read_names & session_names:
+            return True
+        # Names new to the notebook are only bound in the session
+        names_globals = {**dict.fromkeys(session_names), **globals_}
+        held_names = session_names.union(self.jupyter_variables)
+        return bool(
+            resolve_read_variables(
+                read_names, sorted(held_names), names_globals
+            )
+        )
+
+    def dump_standby_runtime(self, runtime_prefix):
+        """
+        Dump the runtime environment and sys.path of the notebook for a
+        standby process to files starting with runtime_prefix. Returns
+        them as they were dumped.
+        """
+        os_environ_, sys_path_ = notebook_runtime()
+        dump_runtime(
+            os_environ_,
+            sys_path_,
+            f"{runtime_prefix}_os_environ",
+            f"{runtime_prefix}_sys_path",
+            pickle,
+        )
+        return os_environ_, sys_path_
+
+    def standby_wrapper(self, runtime_prefix):
+        """
+        Code of a standby subprocess, which loads the runtime dumped by
+        dump_standby_runtime(), then imports the marshaller and the modules
+        of the notebook while waiting for the cell. Then it runs the script
+        whose path it reads from stdin. Nothing reads its output while it's
+        waiting, so it's kept in files until then. Recording is switched
+        off until the script runs, without a script the process exits
+        without finalizing Score-P.
+        """
+        modules = [self.marshaller] + extract_imported_modules(
+            self.jupyter_definitions
+        )
+        runtime_paths = [
+            f"{runtime_prefix}_os_environ",
+            f"{runtime_prefix}_sys_path",
+        ]
+        return (
+            "import importlib\n"
+            "import os\n"
+            "import pickle\n"
+            "import sys\n"
+            "import tempfile\n"
+            "import scorep.instrumenter\n"
+            "import scorep.user\n"
+            "scorep.user.disable_recording()\n"
+            "os.remove(__file__)\n"
+            "with scorep.instrumenter.disable():\n"
+            "    streams_ = [(fd_, os.dup(fd_), tempfile.TemporaryFile()) "
+            "for fd_ in (1, 2)]\n"
+            "    for fd_, _, file_ in streams_:\n"
+            "        os.dup2(file_.fileno(), fd_)\n"
+            "    from scorep_jupyter.userpersistence import load_runtime\n"
+            "    # Notebook modules are imported with the notebook runtime\n"
+            "    try:\n"
+            "        load_runtime(os.environ, sys.path,"
+            f"'{runtime_paths[0]}','{runtime_paths[1]}',pickle)\n"
+            "    except Exception:\n"
+            "        modules_ = []\n"
+            "    else:\n"
+            f"        modules_ = {modules!r}\n"
+            f"    for path_ in {runtime_paths!r}:\n"
+            "        if os.path.exists(path_):\n"
+            "            os.remove(path_)\n"
+            "    for module_ in modules_:\n"
+            "        try:\n"
+            "            importlib.import_module(module_)\n"
+            "        except Exception:\n"
+            "            pass\n"
+            "    script_path_ = sys.stdin.readline().strip()\n"
+            "    sys.stdout.flush()\n"
+            "    sys.stderr.flush()\n"
+            "    for fd_, pipe_fd_, file_ in streams_:\n"
+            "        os.dup2(pipe_fd_, fd_)\n"
+            "        os.close(pipe_fd_)\n"
+            "        file_.seek(0)\n"
+            "        if script_path_:\n"
+            "            os.write(fd_, file_.read())\n"
+            "        file_.close()\n"
+            "if not script_path_:\n"
+            "    os._exit(0)\n"
+            "scorep.user.enable_recording()\n"
+            "with open(script_path_) as file_:\n"
+            "    code_ = file_.read()\n"
+            "exec(compile(code_, script_path_, 'exec'),"
+            "{'__name__': '__main__', '__file__': script_path_})\n"
+        )
+
+    def phase_timestamp(self, phase):
+        """
+        Record the end of a phase in the subprocess for the phase report.
+        """
+        if not self.phase_report_format:
+            return ""
+        return f"timestamps_.append(({repr(phase)}, time.time()))\n"
+
+    def persistence_phase(self, phase, code):
+        """
+        Wrap persistence code of the subprocess, so that it isn't recorded
+        by the instrumenter unless persistence tracing was requested. With
+        phase regions, it's recorded as a user region named after the phase.
+        """
+        region = ""
+        if self.is_phase_regions:
+            region = repr(phase_region_prefix + phase)
+        if self.is_persistence_traced:
+            if not region:
+                code = code if code.endswith("\n") else code + "\n"
+                return code + self.phase_timestamp(phase)
+            context = f"scorep.user.region({region})"
+        else:
+            context = f"scorep.instrumenter.disable({region})"
+        return (
+            f"with {context}:\n"
+            + "".join(f"    {line}\n" for line in code.splitlines())
+            + self.phase_timestamp(phase)
+        )
+
+    def cell_phase(self, cell_name, code, namespace=None):
+        """
+        Record the cell code as a user region, which is ended even if the
+        code raises. The code is compiled from a string then, indenting it
+        would change multiline strings. It runs in namespace, if given,
+        instead of the globals of the script.
+        """
+        if self.is_phase_regions or namespace:
+            code = (
+                f"exec(compile({code!r}, __file__, 'exec'), "
+                f"{namespace or 'globals()'})\n"
+            )
+        if self.is_phase_regions:
+            region = repr(phase_region_prefix + cell_name)
+            code = (
+                f"scorep.user.region_begin({region})\n"
+                "try:\n"
+                f"    {code}"
+                "finally:\n"
+                f"    scorep.user.region_end({region})\n"
+            )
+        return code + self.phase_timestamp("cell")
+
+    def load_variables_call(self):
+        """
+        Generate call loading notebook variables in subprocess.
+        """
+        load_function = (
+            "load_variables_delta"
+            if self.is_delta_transfer
+            else self.load_function("jupyter")
+        )
+        return (
+            f"{load_function}(globals(),'{self.paths['jupyter']['var']}',"
+            f"{self.marshaller})"
+        )
 
     def jupyter_update(self, code):
         """
@@ -192,17 +671,22 @@ class PersHelper:
         entire notebook.
         """
         self.parse(code, "jupyter")
+        load_function = self.load_function("subprocess")
+        if self.is_lazy_loading:
+            load_function = "load_variables_lazy"
+            self.lazy_variables.update(self.subprocess_variables)
         jupyter_update = (
             "import sys\n"
             "import os\n"
             "from scorep_jupyter.userpersistence import load_runtime, "
-            "load_variables\n"
+            "load_variables, load_variables_lazy, load_variables_records, "
+            "load_variables_stream\n"
             f"load_runtime(os.environ, sys.path,"
             f"'{self.paths['subprocess']['os_environ']}',"
             f"'{self.paths['subprocess']['sys_path']}',{self.marshaller})\n"
             f"{self.jupyter_definitions}"
-            f"load_variables(globals(),'{self.paths['subprocess']['var']}', "
-            f"{self.marshaller})\n"
+            f"{load_function}(globals(),"
+            f"'{self.paths['subprocess']['var']}', {self.marshaller})\n"
         )
 
         return jupyter_update
@@ -230,35 +714,196 @@ class PersHelper:
             self.jupyter_definitions += user_definitions
             self.jupyter_variables.extend(user_variables)
 
+    def materialize(self, code, globals_):
+        """
+        Deserialize lazily loaded variables the code might read, including
+        variables read by notebook functions and classes reachable from
+        them. All of them are deserialized if code is None or its reads
+        can't be determined.
+        """
+        if not self.lazy_variables:
+            return
+        read_names = None
+        has_magics = code is None or any(
+            line.strip().startswith(("%", "!")) for line in code.splitlines()
+        )
+        if not has_magics:
+            try:
+                read_names = extract_read_names(code)
+            except SyntaxError:
+                pass
+        self.materialize_read_names(read_names, globals_)
+
+    def materialize_identifiers(self, code, globals_):
+        """
+        Deserialize lazily loaded variables named in code which might be
+        incomplete, e.g. for completion or inspection, and variables read
+        by notebook functions and classes reachable from them.
+        """
+        if self.lazy_variables:
+            self.materialize_read_names(
+                set(identifier_pattern.findall(code)), globals_
+            )
+
+    def materialize_read_names(self, read_names, globals_):
+        """
+        Deserialize lazily loaded variables the names might read, all of
+        them if read_names is None.
+        """
+        while True:
+            # Placeholders rebound by the notebook are gone for good
+            self.lazy_variables = {
+                name
+                for name in self.lazy_variables
+                if isinstance(globals_.get(name), LazyVariable)
+            }
+            names = self.lazy_variables & set(
+                resolve_read_variables(
+                    read_names, sorted(self.lazy_variables), globals_
+                )
+            )
+            if not names:
+                return
+            # Materialized functions might read further lazy variables
+            for name in names:
+                globals_[name] = globals_[name].materialize()
+            self.lazy_variables -= names
+
+    def place_persistence(self, globals_):
+        """
+        Choose the directory of the files of disk mode for the variables
+        about to be transferred. Returns the directory. The size of the
+        variables is only estimated for the first transfer, later ones
+        assume the size of the previous dump.
+        """
+        configured_dir = os.environ["SCOREP_JUPYTER_PERSISTENCE_DIR"]
+        self.base_path = Path(configured_dir) / Path("./kernel_persistence/")
+        if self.mode != "disk" or self.persistence_placement != "auto":
+            return configured_dir
+
+        payload_size = self.transfer_size
+        if payload_size is None:
+            # Not needed by the subprocess importing this module
+            from parallel_marshall.size_estimators import deep_size
+
+            payload_size = sum(
+                deep_size(globals_[name])
+                for name in self.jupyter_variables
+                if name in globals_
+            )
+        for directory in persistence_candidates():
+            if (
+                os.path.isdir(directory)
+                and os.access(directory, os.W_OK | os.X_OK)
+                and free_space(directory)
+                >= payload_size * placement_space_factor
+            ):
+                # Directory is shared with other kernels and users
+                self.base_path = Path(directory) / Path(
+                    f"scorep_jupyter_persistence_{os.getpid()}"
+                )
+                return directory
+        return configured_dir
+
     def set_dump_report_level(self):
         self.is_dump_detailed_report = int(
             os.getenv("SCOREP_JUPYTER_MARSHALLING_DETAILED_REPORT", "0")
         )
+        self.phase_report_format = os.getenv("SCOREP_JUPYTER_PHASE_REPORT", "")
+
+    def set_transfer_settings(self):
+        # Cached dumps can't be reused with marshallers removing their data
+        # after loading
+        self.is_delta_transfer = (
+            int(os.getenv("SCOREP_JUPYTER_DELTA_TRANSFER", "0"))
+            and self.marshaller not in single_use_marshallers
+        )
+        self.is_read_set_transfer = int(
+            os.getenv("SCOREP_JUPYTER_READ_SET_TRANSFER", "0")
+        )
+        # Marshallers splitting the dump into several files/pipes need the
+        # file itself, streaming needs a pickler kept across variables
+        self.is_streaming_transfer = (
+            int(os.getenv("SCOREP_JUPYTER_STREAMING_TRANSFER", "0"))
+            and self.marshaller not in single_use_marshallers
+            and hasattr(importlib.import_module(self.marshaller), "Pickler")
+        )
+        # Variables are kept serialized per record
+        self.is_lazy_loading = self.is_streaming_transfer and int(
+            os.getenv("SCOREP_JUPYTER_LAZY_LOADING", "0")
+        )
+        self.is_lazy_faulting = (
+            self.is_streaming_transfer
+            and not self.is_delta_transfer
+            and int(os.getenv("SCOREP_JUPYTER_LAZY_FAULTING", "0"))
+        )
+        # Instrumenting the marshaller is only useful to debug persistence
+        self.is_persistence_traced = int(
+            os.getenv("SCOREP_JUPYTER_TRACE_PERSISTENCE", "0")
+        )
+        self.is_phase_regions = int(
+            os.getenv("SCOREP_JUPYTER_PHASE_REGIONS", "0")
+        )
+        self.persistence_placement = os.getenv(
+            "SCOREP_JUPYTER_PERSISTENCE_PLACEMENT", "auto"
+        )
 
 
-def dump_runtime(
-    os_environ_, sys_path_, os_environ_dump_, sys_path_dump_, marshaller
-):
+def persistence_candidates():
+    """
+    Directories tried for automatically placed disk mode persistence in
+    order of preference: RAM-backed ones, then node-local scratch.
+    """
+    candidates = ["/dev/shm", os.getenv("XDG_RUNTIME_DIR", "")]
+    candidates.append(tempfile.gettempdir())
+    return [directory for directory in candidates if directory]
+
+
+def free_space(path):
+    stat = os.statvfs(path)
+    return stat.f_bavail * stat.f_frsize
+
+
+def runtime_environ(os_environ_):
     # Don't dump environment variables set by Score-P bindings.
     # Will force it to re-initialize instead of calling reset_preload()
-    filtered_os_environ_ = {
+    return {
         k: v
         for k, v in os_environ_.items()
         if not k.startswith("SCOREP_") or "SCOREP_JUPYTER" in k
     }
 
+
+def notebook_runtime():
+    """
+    Runtime environment and sys.path of the notebook as they are dumped.
+    """
+    return runtime_environ(os.environ), list(sys.path)
+
+
+def dump_runtime(
+    os_environ_, sys_path_, os_environ_dump_, sys_path_dump_, marshaller
+):
+    filtered_os_environ_ = runtime_environ(os_environ_)
+
+    size = 0
     with os.fdopen(
         os.open(os_environ_dump_, os.O_WRONLY | os.O_CREAT), "wb"
     ) as file:
+        file = CountingFile(file)
         marshaller.dump(filtered_os_environ_, file)
+        size += file.size
 
     with os.fdopen(
         os.open(sys_path_dump_, os.O_WRONLY | os.O_CREAT), "wb"
     ) as file:
+        file = CountingFile(file)
         marshaller.dump(sys_path_, file)
+        size += file.size
+    return size
 
 
-def dump_variables(variables_names, globals_, var_dump_, marshaller):
+def select_user_variables(variables_names, globals_):
     user_variables = {
         k: v
         for k, v in globals_.items()
@@ -274,8 +919,282 @@ def dump_variables(variables_names, globals_, var_dump_, marshaller):
         if non_persistent_class in globals().keys():
             user_variables[el].__class__ = globals()[non_persistent_class]
 
+    return user_variables
+
+
+def dump_variables(variables_names, globals_, var_dump_, marshaller):
+    user_variables = select_user_variables(variables_names, globals_)
+
     with os.fdopen(os.open(var_dump_, os.O_WRONLY | os.O_CREAT), "wb") as file:
+        file = CountingFile(file)
         marshaller.dump(user_variables, file)
+    return file.size
+
+
+def dump_variables_stream(variables_names, globals_, var_dump_, marshaller):
+    """
+    Dump variables one by one with a single pickler, so the loading side
+    deserializes a variable while the next one is serialized. Objects
+    shared between variables are pickled once, the memo of the pickler is
+    kept across them. The stream ends with None in place of a name.
+    """
+    user_variables = select_user_variables(variables_names, globals_)
+
+    with os.fdopen(os.open(var_dump_, os.O_WRONLY | os.O_CREAT), "wb") as file:
+        file = CountingFile(file)
+        pickler = marshaller.Pickler(file)
+        for name, value in user_variables.items():
+            pickler.dump(name)
+            pickler.dump(value)
+            file.flush()
+        pickler.dump(None)
+    return file.size
+
+
+def dump_variables_records(variables_names, globals_, var_dump_, marshaller):
+    """
+    Dump variables as a stream of records, one per variable, framed by the
+    lengths of its name and serialized value. Every variable is serialized
+    on its own, so that it can be deserialized independently of the other
+    ones, objects shared between variables are copied.
+    """
+    user_variables = select_user_variables(variables_names, globals_)
+
+    with os.fdopen(os.open(var_dump_, os.O_WRONLY | os.O_CREAT), "wb") as file:
+        file = CountingFile(file)
+        for name, value in user_variables.items():
+            buffer = io.BytesIO()
+            marshaller.dump(value, buffer)
+            encoded_name = name.encode("utf-8")
+            file.write(
+                stream_record_header.pack(len(encoded_name), buffer.tell())
+            )
+            file.write(encoded_name)
+            file.write(buffer.getbuffer())
+            file.flush()
+    return file.size
+
+
+def code_names(code):
+    """
+    Names referenced by the code object and code objects nested in it.
+    """
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            names |= code_names(const)
+    return names
+
+
+def notebook_code_objects(obj, globals_, visited):
+    """
+    Yield code objects of functions defined in the notebook that are reachable
+    from the object, e.g. methods of its class or functions it holds.
+    Raises RecursionError if more than read_set_max_objects were visited.
+    """
+    pending = [obj]
+    while pending:
+        obj = pending.pop()
+        if id(obj) in visited:
+            continue
+        visited.add(id(obj))
+        if len(visited) > read_set_max_objects:
+            raise RecursionError("Too many objects to analyze")
+
+        if obj is globals_ or isinstance(obj, types.ModuleType):
+            continue
+        elif isinstance(obj, types.FunctionType):
+            if obj.__module__ == "__main__":
+                yield obj.__code__
+            pending.extend(obj.__defaults__ or ())
+            pending.extend((obj.__kwdefaults__ or {}).values())
+            for cell in obj.__closure__ or ():
+                try:
+                    pending.append(cell.cell_contents)
+                except ValueError:
+                    # Cell variable that isn't assigned yet
+                    pass
+        elif isinstance(obj, type):
+            if obj.__module__ == "__main__":
+                pending.extend(vars(obj).values())
+                pending.extend(obj.__bases__)
+        else:
+            pending.append(type(obj))
+            pending.extend(gc.get_referents(obj))
+
+
+def resolve_read_variables(read_names, variables_names, globals_):
+    """
+    Select notebook variables read by the subprocess code. Functions and
+    classes defined in the notebook read further variables when called,
+    so names referenced in their code are followed transitively.
+    Falls back to all variables if completeness can't be proven.
+    """
+    if read_names is None:
+        return variables_names
+
+    selected = set()
+    visited = set()
+    pending = list(read_names)
+    try:
+        while pending:
+            name = pending.pop()
+            if name in selected or name not in globals_:
+                continue
+            selected.add(name)
+            for code in notebook_code_objects(
+                globals_[name], globals_, visited
+            ):
+                names = code_names(code)
+                if names & dynamic_namespace_builtins:
+                    return variables_names
+                pending.extend(names)
+    except RecursionError:
+        return variables_names
+
+    return [name for name in variables_names if name in selected]
+
+
+def variable_fingerprint(obj):
+    """
+    Cheap fingerprint of a variable: type and identity of the object, plus
+    hash of immutable values and checksum of the content for contiguous
+    buffers (e.g. NumPy arrays), so that in-place modifications made
+    through another name are noticed. None for other objects. Shape,
+    format and strides of buffers are included as well, they can be
+    changed in place without touching the content (e.g. a.shape = (2, 3)).
+    """
+    checksum = None
+    layout = None
+    if isinstance(obj, immutable_types):
+        # Identity of a freed object might be reused by another value
+        checksum = hash(obj)
+    else:
+        try:
+            with memoryview(obj) as view:
+                if view.c_contiguous:
+                    checksum = zlib.crc32(view.cast("B"))
+                    # Lists, as they are compared with the JSON manifest
+                    layout = [
+                        list(view.shape),
+                        view.format,
+                        list(view.strides),
+                    ]
+        except (TypeError, ValueError):
+            pass
+    return [type(obj).__qualname__, id(obj), checksum, layout]
+
+
+def cacheable_variables(user_variables):
+    """
+    Names of the variables whose dumps can be reused while their
+    fingerprint is unchanged: immutable values, and contiguous buffers
+    owning their data which no other variable refers to. Other objects
+    might be modified through any reference, and objects shared between
+    variables have to be dumped together to stay shared.
+    """
+    # Not needed by the subprocess importing this module
+    from parallel_marshall.shared_references import find_shared_objects
+
+    names = set()
+    buffers = set()
+    for name, value in user_variables.items():
+        if isinstance(value, immutable_types):
+            names.add(name)
+        elif (
+            variable_fingerprint(value)[2] is not None
+            and getattr(value, "base", None) is None
+        ):
+            buffers.add(name)
+    if not buffers:
+        return names
+
+    shared_objects = find_shared_objects(
+        [{name: value} for name, value in user_variables.items()]
+    )
+    if shared_objects is None:
+        return names
+    shared_ids = {id(obj) for obj in shared_objects}
+    # Views of a buffer refer to it by their base
+    shared_ids.update(
+        id(value.base)
+        for value in user_variables.values()
+        if getattr(value, "base", None) is not None
+    )
+    return names | {
+        name for name in buffers if id(user_variables[name]) not in shared_ids
+    }
+
+
+def dump_variables_delta(
+    variables_names, globals_, var_dump_, marshaller, cache_dir_
+):
+    """
+    Dump only variables changed since the last transfer. Variables whose
+    dumps can be reused (see cacheable_variables()) are kept in their own
+    versioned file in the cache directory, the subprocess receives the
+    paths of their current versions and all other variables, which are
+    dumped in every transfer.
+    """
+    manifest_path = os.path.join(cache_dir_, delta_manifest_name)
+    manifest = {"marshaller": marshaller.__name__, "variables": {}}
+    if os.path.exists(manifest_path):
+        with open(manifest_path, "r") as file:
+            cached_manifest = json.load(file)
+        # Cached dumps are only valid for the same marshaller
+        if cached_manifest["marshaller"] == marshaller.__name__:
+            manifest = cached_manifest
+    os.makedirs(cache_dir_, exist_ok=True)
+
+    user_variables = select_user_variables(variables_names, globals_)
+    cacheable_names = cacheable_variables(user_variables)
+    size = 0
+    outdated_paths = []
+    fresh_variables = {}
+    for name, value in user_variables.items():
+        entry = manifest["variables"].get(name)
+        if name not in cacheable_names:
+            fresh_variables[name] = value
+            if entry:
+                outdated_paths.append(entry["path"])
+                del manifest["variables"][name]
+            continue
+        fingerprint = variable_fingerprint(value)
+        if entry is not None and entry["fingerprint"] == fingerprint:
+            continue
+
+        version = entry["version"] + 1 if entry else 0
+        path = os.path.join(cache_dir_, f"{name}.{version}")
+        with open(path, "wb") as file:
+            file = CountingFile(file)
+            marshaller.dump(value, file)
+            size += file.size
+        if entry:
+            outdated_paths.append(entry["path"])
+        manifest["variables"][name] = {
+            "fingerprint": fingerprint,
+            "version": version,
+            "path": path,
+        }
+
+    # Replace old versions only after the manifest points to the new ones
+    with open(manifest_path, "w") as file:
+        json.dump(manifest, file)
+    for path in outdated_paths:
+        if os.path.exists(path):
+            os.remove(path)
+
+    cached_paths = {
+        name: manifest["variables"][name]["path"]
+        for name in user_variables
+        if name in cacheable_names
+    }
+    with os.fdopen(os.open(var_dump_, os.O_WRONLY | os.O_CREAT), "wb") as file:
+        file = CountingFile(file)
+        marshaller.dump(
+            {"cached": cached_paths, "variables": fresh_variables}, file
+        )
+    return size + file.size
 
 
 def load_runtime(
@@ -303,6 +1222,144 @@ def load_variables(globals_, var_dump_, marshaller):
     globals_.update(obj)
 
 
+def read_exactly(file, size):
+    data = file.read(size)
+    if len(data) < size:
+        raise EOFError("Variables stream ended within a record")
+    return data
+
+
+def read_variable_records(file):
+    """
+    Yield names and serialized values of the records written by
+    dump_variables_records().
+    """
+    while True:
+        header = file.read(stream_record_header.size)
+        if not header:
+            return
+        if len(header) < stream_record_header.size:
+            raise EOFError("Variables stream ended within a record")
+        name_size, value_size = stream_record_header.unpack(header)
+        name = read_exactly(file, name_size).decode("utf-8")
+        yield name, read_exactly(file, value_size)
+
+
+def load_variables_stream(globals_, var_dump_, marshaller):
+    """
+    Load variables streamed by dump_variables_stream() one by one.
+    """
+    with os.fdopen(os.open(var_dump_, os.O_RDONLY), "rb") as file:
+        unpickler = getattr(marshaller, "Unpickler", pickle.Unpickler)(file)
+        while True:
+            name = unpickler.load()
+            if name is None:
+                return
+            globals_[name] = unpickler.load()
+
+
+def load_variables_records(globals_, var_dump_, marshaller):
+    """
+    Load variables streamed by dump_variables_records() record by record.
+    """
+    with os.fdopen(os.open(var_dump_, os.O_RDONLY), "rb") as file:
+        for name, value in read_variable_records(file):
+            globals_[name] = marshaller.load(io.BytesIO(value))
+
+
+class LazyVariable:
+    """
+    Placeholder of a variable received from the subprocess, which keeps its
+    serialized value until PersHelper.materialize() finds it's read.
+    """
+
+    def __init__(self, name, value, marshaller):
+        self.name = name
+        self.value = value
+        self.marshaller = marshaller
+
+    def materialize(self):
+        return self.marshaller.load(io.BytesIO(self.value))
+
+    def __repr__(self):
+        return f"<{self.name} not loaded from Score-P subprocess yet>"
+
+
+def load_variables_lazy(globals_, var_dump_, marshaller):
+    """
+    Receive variables streamed by dump_variables_records() without
+    deserializing them, placeholders are bound in their place.
+    """
+    with os.fdopen(os.open(var_dump_, os.O_RDONLY), "rb") as file:
+        for name, value in read_variable_records(file):
+            globals_[name] = LazyVariable(name, value, marshaller)
+
+
+def main_namespace():
+    return sys.modules["__main__"].__dict__
+
+
+class FaultingNamespace(dict):
+    """
+    Namespace of the subprocess code, variables received from the kernel
+    are deserialized when the code looks them up for the first time.
+    """
+
+    def __init__(self, records, marshaller, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.records = records
+        self.marshaller = marshaller
+
+    def __missing__(self, name):
+        if name in self.records:
+            value = self.marshaller.load(io.BytesIO(self.records.pop(name)))
+        elif hasattr(builtins, name):
+            # Builtins are looked up in the namespace first, keep them so
+            # that __missing__ isn't called (and instrumented) every time
+            value = getattr(builtins, name)
+        else:
+            raise KeyError(name)
+        self[name] = value
+        return value
+
+    def __contains__(self, name):
+        return super().__contains__(name) or name in self.records
+
+    def __reduce__(self):
+        # Globals of functions defined in the code, stand for __main__ as
+        # they would without the namespace
+        return main_namespace, ()
+
+
+def load_variables_faulting(globals_, definitions, var_dump_, marshaller):
+    """
+    Receive variables streamed by dump_variables_records() without
+    deserializing them. Returns a FaultingNamespace based on globals_ with
+    the definitions executed in it.
+    """
+    with os.fdopen(os.open(var_dump_, os.O_RDONLY), "rb") as file:
+        records = dict(read_variable_records(file))
+    namespace = FaultingNamespace(records, marshaller, globals_)
+    exec(definitions, namespace)
+    # Received variables replace definitions of the same name
+    for name in records:
+        namespace.pop(name, None)
+    return namespace
+
+
+def load_variables_delta(globals_, var_dump_, marshaller):
+    """
+    Load variables sent by dump_variables_delta(), those reused from
+    earlier transfers from their cache files.
+    """
+    with os.fdopen(os.open(var_dump_, os.O_RDONLY), "rb") as file:
+        transfer = marshaller.load(file)
+    for name, path in transfer["cached"].items():
+        with open(path, "rb") as file:
+            globals_[name] = marshaller.load(file)
+    globals_.update(transfer["variables"])
+
+
 def extract_definitions(code):
     """
     Extract imported modules and definitions of classes and functions from
@@ -339,6 +1396,215 @@ def extract_definitions(code):
     return definitions_string
 
 
+class ReadNamesVisitor(ast.NodeVisitor):
+    """
+    Load/store analysis of a scope. Collects names loaded in the scope and
+    free names of nested functions, lambdas, classes and comprehensions,
+    i.e. names they read from the enclosing scopes.
+    """
+
+    def __init__(self):
+        self.loads = set()
+        self.stores = set()
+        self.nested_loads = set()
+        self.declared = set()
+        self.is_dynamic = False
+
+    def read_names(self):
+        return self.loads | self.nested_loads
+
+    def visit_Name(self, node):
+        if isinstance(node.ctx, ast.Store):
+            self.stores.add(node.id)
+        else:
+            self.loads.add(node.id)
+            if node.id in dynamic_namespace_builtins:
+                self.is_dynamic = True
+
+    def visit_Attribute(self, node):
+        # sys.modules["__main__"] gives access to the whole namespace
+        if (
+            node.attr == "modules"
+            and isinstance(node.value, ast.Name)
+            and node.value.id == "sys"
+        ):
+            self.is_dynamic = True
+        self.generic_visit(node)
+
+    def visit_AugAssign(self, node):
+        if isinstance(node.target, ast.Name):
+            self.loads.add(node.target.id)
+        self.generic_visit(node)
+
+    def visit_Global(self, node):
+        self.declared.update(node.names)
+
+    visit_Nonlocal = visit_Global
+
+    def visit_Import(self, node):
+        for alias in node.names:
+            if alias.name == "__main__":
+                self.is_dynamic = True
+            self.stores.add((alias.asname or alias.name).split(".")[0])
+
+    def visit_ImportFrom(self, node):
+        if node.module == "__main__":
+            self.is_dynamic = True
+        for alias in node.names:
+            if alias.name != "*":
+                self.stores.add(alias.asname or alias.name)
+
+    def visit_ExceptHandler(self, node):
+        if node.name:
+            self.stores.add(node.name)
+        self.generic_visit(node)
+
+    def visit_MatchAs(self, node):
+        if node.name:
+            self.stores.add(node.name)
+        self.generic_visit(node)
+
+    visit_MatchStar = visit_MatchAs
+
+    def visit_MatchMapping(self, node):
+        if node.rest:
+            self.stores.add(node.rest)
+        self.generic_visit(node)
+
+    def visit_FunctionDef(self, node):
+        for decorator in node.decorator_list:
+            self.visit(decorator)
+        self.visit_signature(node.args)
+        if node.returns:
+            self.visit(node.returns)
+        self.stores.add(node.name)
+        self.visit_nested_scope(node.body, node.args)
+
+    visit_AsyncFunctionDef = visit_FunctionDef
+
+    def visit_Lambda(self, node):
+        self.visit_signature(node.args)
+        self.visit_nested_scope([node.body], node.args)
+
+    def visit_ClassDef(self, node):
+        for expr in node.decorator_list + node.bases:
+            self.visit(expr)
+        for keyword in node.keywords:
+            self.visit(keyword.value)
+        self.stores.add(node.name)
+
+        # Names assigned in the class body aren't visible to its methods.
+        # Like at module level, a name loaded in the body might be read
+        # from the globals before it's assigned there (e.g. x = x).
+        scope = ReadNamesVisitor()
+        for stmt in node.body:
+            scope.visit(stmt)
+        self.nested_loads |= scope.loads | scope.nested_loads
+        self.is_dynamic |= scope.is_dynamic
+
+    def visit_comprehension_scope(self, node, elements):
+        # The first iterable is evaluated in the enclosing scope
+        self.visit(node.generators[0].iter)
+        scope = ReadNamesVisitor()
+        for i, generator in enumerate(node.generators):
+            scope.visit(generator.target)
+            if i > 0:
+                scope.visit(generator.iter)
+            for condition in generator.ifs:
+                scope.visit(condition)
+        for element in elements:
+            scope.visit(element)
+        self.merge_nested_scope(scope, set())
+
+    def visit_ListComp(self, node):
+        self.visit_comprehension_scope(node, [node.elt])
+
+    visit_SetComp = visit_GeneratorExp = visit_ListComp
+
+    def visit_DictComp(self, node):
+        self.visit_comprehension_scope(node, [node.key, node.value])
+
+    def visit_signature(self, args):
+        # Defaults and annotations are evaluated in the enclosing scope
+        for default in args.defaults + args.kw_defaults:
+            if default:
+                self.visit(default)
+        for arg in self.arguments(args):
+            if arg.annotation:
+                self.visit(arg.annotation)
+
+    def visit_nested_scope(self, body, args):
+        scope = ReadNamesVisitor()
+        for stmt in body:
+            scope.visit(stmt)
+        self.merge_nested_scope(
+            scope, {arg.arg for arg in self.arguments(args)}
+        )
+
+    def merge_nested_scope(self, scope, parameters):
+        local_names = (scope.stores | parameters) - scope.declared
+        self.nested_loads |= scope.read_names() - local_names
+        self.is_dynamic |= scope.is_dynamic
+
+    @staticmethod
+    def arguments(args):
+        arguments = args.posonlyargs + args.args + args.kwonlyargs
+        if args.vararg:
+            arguments.append(args.vararg)
+        if args.kwarg:
+            arguments.append(args.kwarg)
+        return arguments
+
+
+def extract_read_names(code):
+    """
+    Extract names the code reads from the global namespace, including free
+    names of functions, classes and comprehensions defined in it. Returns
+    None if the code accesses the namespace dynamically (e.g. eval(),
+    globals()), so the read names can't be determined.
+    """
+    visitor = ReadNamesVisitor()
+    visitor.visit(ast.parse(code))
+    if visitor.is_dynamic:
+        return None
+    return visitor.read_names()
+
+
+def extract_bound_names(code):
+    """
+    Names the code binds or deletes: targets of assignments (also augmented
+    ones and :=), for loops, with statements and del, names of functions,
+    classes and imports, also nested ones.
+    """
+    names = set()
+    for node in ast.walk(ast.parse(code)):
+        if isinstance(node, ast.Name) and not isinstance(node.ctx, ast.Load):
+            names.add(node.id)
+        elif isinstance(
+            node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)
+        ):
+            names.add(node.name)
+        elif isinstance(node, (ast.Import, ast.ImportFrom)):
+            names.update(
+                (alias.asname or alias.name).split(".")[0]
+                for alias in node.names
+            )
+    return names
+
+
+def extract_imported_modules(code):
+    """
+    Names of the modules imported by the code, except relative imports.
+    """
+    modules = []
+    for node in ast.walk(ast.parse(code)):
+        if isinstance(node, ast.Import):
+            modules.extend(alias.name for alias in node.names)
+        elif isinstance(node, ast.ImportFrom) and not node.level:
+            modules.append(node.module)
+    return modules
+
+
 def extract_variables_names(code):
     """
     Extract user-assigned variables from code. Unlike dir(), nothing coming
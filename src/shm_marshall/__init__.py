@@ -0,0 +1,2 @@
+__all__ = ["dump", "load", "cleanup"]
+from shm_marshall.shm_marshall import dump, load, cleanup
@@ -0,0 +1,132 @@
+import os
+import io
+import glob
+import mmap
+import pickle
+import uuid
+import importlib
+import logging
+
+# Large contiguous buffers (e.g. NumPy arrays) are serialized out-of-band
+# with pickle protocol 5 and moved through shared memory segments, only the
+# remaining pickle stream is written to the file/pipe passed for dumping
+backend = str(os.environ.get("SCOREP_JUPYTER_SHM_MARSHALL_BACKEND", "dill"))
+shm_dir = str(os.environ.get("SCOREP_JUPYTER_SHM_MARSHALL_DIR", "/dev/shm"))
+# Smaller buffers are cheaper to copy through the pipe than to map
+threshold = int(
+    os.environ.get("SCOREP_JUPYTER_SHM_MARSHALL_THRESHOLD", 1024 * 1024)
+)
+
+logger = logging.getLogger(__name__)
+
+try:
+    serializer_backend = importlib.import_module(backend)
+except ModuleNotFoundError:
+    print("Backend marshalling module not found. Exit.")
+    logger.error("Backend marshalling module not found. Exit.")
+    exit(1)
+
+
+class BufferPickler(serializer_backend.Pickler):
+    def reducer_override(self, obj):
+        # dill reduces NumPy arrays with __reduce__(), which copies the data
+        # into the pickle stream instead of providing a PickleBuffer
+        obj_type = type(obj)
+        if obj_type.__module__ == "numpy" and obj_type.__name__ == "ndarray":
+            return obj.__reduce_ex__(5)
+        parent_reducer_override = getattr(super(), "reducer_override", None)
+        if parent_reducer_override is not None:
+            return parent_reducer_override(obj)
+        return NotImplemented
+
+
+def segment_prefix(file):
+    """
+    Segments are named after the file/pipe they belong to, so leftovers of
+    an interrupted transfer can be removed with cleanup().
+    """
+    try:
+        path = os.readlink(f"/proc/self/fd/{file.fileno()}")
+    except OSError:
+        path = "scorep_jupyter_shm"
+    return os.path.basename(path)
+
+
+def dump(obj, file):
+    prefix = segment_prefix(file)
+    segments = []
+
+    def buffer_callback(buffer):
+        try:
+            raw = buffer.raw()
+        except BufferError:
+            # Non-contiguous buffer, serialize in-band
+            return True
+        with raw:
+            size = raw.nbytes
+            # Writing into a segment beyond free space crashes with SIGBUS
+            if (
+                size < threshold
+                or not os.path.isdir(shm_dir)
+                or free_space(shm_dir) < size
+            ):
+                return True
+            path = os.path.join(
+                shm_dir, f"{prefix}_{len(segments)}_{uuid.uuid4().hex}"
+            )
+            fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_EXCL, 0o600)
+            segments.append((path, size))
+            try:
+                os.ftruncate(fd, size)
+                with mmap.mmap(fd, size) as segment:
+                    segment[:] = raw
+            finally:
+                os.close(fd)
+        return False
+
+    stream = io.BytesIO()
+    try:
+        BufferPickler(
+            stream, protocol=5, buffer_callback=buffer_callback
+        ).dump(obj)
+        logger.debug(f"{len(segments)} buffers moved to shared memory")
+        pickle.dump((segments, stream.getvalue()), file, protocol=5)
+    except BaseException:
+        for path, _ in segments:
+            if os.path.exists(path):
+                os.unlink(path)
+        raise
+    file.close()
+
+
+def load(file):
+    segments, data = pickle.load(file)
+    file.close()
+
+    buffers = []
+    for path, size in segments:
+        fd = os.open(path, os.O_RDWR)
+        try:
+            # Mapping outlives the file, objects reference it without copy
+            buffers.append(mmap.mmap(fd, size))
+        finally:
+            os.close(fd)
+            os.unlink(path)
+
+    return serializer_backend.loads(data, buffers=buffers)
+
+
+def cleanup(path):
+    """
+    Remove segments left by a dump to path that was never loaded.
+    """
+    prefix = os.path.basename(path)
+    if not prefix:
+        return
+    for segment_path in glob.glob(os.path.join(shm_dir, f"{prefix}_*")):
+        os.unlink(segment_path)
+
+
+def free_space(path):
+    stat = os.statvfs(path)
+    return stat.f_bavail * stat.f_frsize
@@ -4,6 +4,7 @@ import nbformat
 from unittest.mock import MagicMock
 import jupyter_kernel_test as jkt
 import yaml, re, os
+import time
 
 from scorep_jupyter import logging_config
 from scorep_jupyter.kernel_messages import (
@@ -138,6 +139,109 @@ class KernelTests(jkt.KernelTests):
     def test_05_writemode(self):
         self.check_from_notebook("tests/kernel/writemode.ipynb")
 
+    def test_06_fork(self):
+        self.check_from_notebook("tests/kernel/fork.ipynb")
+
+    def test_07_standby_process(self):
+        # Kernel assigns experiment directories, the standby process of the
+        # second cell is used, the one of the third is replaced
+        directory = os.path.abspath(f"{tmp_dir}/standby")
+        os.mkdir(directory)
+        self.execute_helper(
+            code="%%marshalling_settings\nMARSHALLER=dill\nMODE=memory"
+        )
+        self.execute_helper(
+            code=(
+                "import os\n"
+                "cwd_ = os.getcwd()\n"
+                f"os.chdir({directory!r})\n"
+                "experiment_directory_ = "
+                "os.environ.pop('SCOREP_EXPERIMENT_DIRECTORY')\n"
+                "%env SCOREP_JUPYTER_STANDBY_PROCESS=1"
+            )
+        )
+        reported = []
+        for code in (
+            "%%execute_with_scorep\nx = 1",
+            "%%execute_with_scorep\nx += 1",
+            "%env SCOREP_JUPYTER_STANDBY_PROCESS=0\n"
+            "%env SCOREP_TOTAL_MEMORY=2g",
+            "%%execute_with_scorep\nx += 1",
+        ):
+            reply, output_messages = self.execute_helper(code=code)
+            for line in self.extract_kernel_executed_outputs(output_messages):
+                match = re.match(
+                    "Instrumentation results can be found in (.*)", line
+                )
+                if match:
+                    reported.append(os.path.basename(match.group(1)))
+        reply, output_messages = self.execute_helper(
+            code=(
+                "import os\n"
+                "print(x)\n"
+                "os.environ['SCOREP_EXPERIMENT_DIRECTORY'] = "
+                "experiment_directory_\n"
+                "os.environ['SCOREP_TOTAL_MEMORY'] = '3g'\n"
+                "os.chdir(cwd_)"
+            )
+        )
+        self.assertEqual(
+            self.extract_kernel_executed_outputs(output_messages), ["3"]
+        )
+        self.assertEqual(len(reported), 3)
+        # Replaced standby process is reaped in the background
+        for _ in range(100):
+            directories = [
+                name
+                for name in os.listdir(directory)
+                if name.startswith("scorep-")
+            ]
+            if sorted(directories) == sorted(reported):
+                break
+            time.sleep(0.1)
+        self.assertEqual(sorted(directories), sorted(reported))
+
+    def test_08_repeat(self):
+        # Every repetition runs with its own experiment directory, variables
+        # are loaded from the final one
+        self.execute_helper(code="x = 3")
+        reply, output_messages = self.execute_helper(
+            code="%%execute_with_scorep --repeat 2\ny = x * 10\nprint(y)"
+        )
+        outputs = self.extract_kernel_executed_outputs(output_messages)
+        results = f"{os.getcwd()}/test_kernel_tmp/scorep-traces"
+        self.assertEqual(
+            [line for line in outputs if not line.startswith("Cell wall")],
+            [
+                "Repetition 1/2",
+                "30",
+                f"Instrumentation results can be found in {results}_1",
+                "Repetition 2/2",
+                "30",
+                f"Instrumentation results can be found in {results}_2",
+            ],
+        )
+        self.assertTrue(
+            outputs[-1].startswith("Cell wall time over 2 repetitions: ")
+        )
+        self.assertTrue(os.path.isdir(f"{tmp_dir}/scorep-traces_1"))
+        self.assertTrue(os.path.isdir(f"{tmp_dir}/scorep-traces_2"))
+        reply, output_messages = self.execute_helper(code="print(y)")
+        self.assertEqual(
+            self.extract_kernel_executed_outputs(output_messages), ["30"]
+        )
+
+        # Repetitions are only run in the default mode
+        self.execute_helper(code="%%start_writefile")
+        reply, output_messages = self.execute_helper(
+            code="%%execute_with_scorep --repeat 2\nprint(y)"
+        )
+        self.assertEqual(
+            self.extract_kernel_executed_outputs(output_messages),
+            ["KernelWarning: Currently in writefile, command ignored."],
+        )
+        self.execute_helper(code="%%abort_writefile")
+
 
 class DummyPersHelper:
     def __init__(self, mode="test_mode", marshaller="test_marshal"):
@@ -1,17 +1,76 @@
 import ast
+import collections
+import glob
+import hashlib
+import io
 import unittest
+import unittest.mock
+import multiprocessing
 import os
+import signal
+import statistics
 import sys
 import json
 import subprocess
 import dill
 import cloudpickle
+import threading
+import time
+import numpy
+import shm_marshall
+import parallel_marshall
+from parallel_marshall.balanced_distribution_iterator import (
+    BalancedDistributionIterator,
+    ChunkKey,
+    merge_bins,
+)
+from parallel_marshall.size_estimators import deep_size, serialized_size
+from scorep_jupyter.phase_report import (
+    PhaseReport,
+    phase_report_name,
+    write_subprocess_report,
+)
+from scorep_jupyter.kernel_timeline import KernelTimeline
+from scorep_jupyter.repetitions import (
+    parse_repetitions,
+    repetition_runs,
+)
+from scorep_jupyter.forked_process import ForkedProcess
+from scorep_jupyter.standby_process import (
+    StandbyProcess,
+    run_script,
+    standby_file_prefix,
+)
+from scorep_jupyter.scorep_session import ScorepSession, SessionStream
+from scorep_jupyter.bindings import (
+    PreloadEnvironment,
+    evict_subsystems,
+    subsystem_environment,
+    subsystem_preload_name,
+)
 
 from src.scorep_jupyter.userpersistence import (
     extract_variables_names,
     extract_definitions,
     load_variables,
     load_runtime,
+    dump_runtime,
+    dump_variables,
+    dump_variables_delta,
+    load_variables_delta,
+    dump_variables_stream,
+    load_variables_stream,
+    dump_variables_records,
+    load_variables_records,
+    load_variables_lazy,
+    LazyVariable,
+    PersHelper,
+    scorep_script_name,
+    extract_read_names,
+    extract_imported_modules,
+    extract_bound_names,
+    resolve_read_variables,
+    free_space,
 )
 
 PYTHON_EXECUTABLE = sys.executable
@@ -175,6 +234,1236 @@ class UserPersistenceTests(unittest.TestCase):
                 self.assertEqual(dumped_variables, expected_variables)
                 self.handle_communication("var", mode, "close")
 
+    def test_04_dump_load_variables_delta(self):
+        cache_dir = tmp_dir + "delta_cache"
+        array = numpy.arange(10)
+        user_variables = {"var_a": 42, "list_b": [1, 2], "array_c": array}
+        variables_names = list(user_variables.keys())
+
+        def transfer():
+            var_file = self.handle_communication("var", "disk", "open")[0]
+            dump_variables_delta(
+                variables_names, user_variables, var_file, dill, cache_dir
+            )
+            loaded_variables = {}
+            load_variables_delta(loaded_variables, var_file, dill)
+            self.handle_communication("var", "disk", "close")
+            return loaded_variables
+
+        transfer()
+        cached_files = sorted(os.listdir(cache_dir))
+        # Mutable objects other than buffers aren't cached
+        self.assertNotIn("list_b.0", cached_files)
+
+        # Nothing modified, cached dumps are reused
+        loaded_variables = transfer()
+        self.assertEqual(sorted(os.listdir(cache_dir)), cached_files)
+        self.assertEqual(loaded_variables["list_b"], [1, 2])
+
+        # Modified in-place through aliases, var_a rebound
+        alias = user_variables["list_b"]
+        alias.append(3)
+        array[0] = 100
+        user_variables["var_a"] = 43
+        loaded_variables = transfer()
+        self.assertEqual(loaded_variables["var_a"], 43)
+        self.assertEqual(loaded_variables["list_b"], [1, 2, 3])
+        self.assertEqual(loaded_variables["array_c"][0], 100)
+        self.assertIn("var_a.1", os.listdir(cache_dir))
+        self.assertIn("array_c.1", os.listdir(cache_dir))
+        self.assertNotIn("array_c.0", os.listdir(cache_dir))
+
+        # Objects shared between variables stay shared
+        user_variables["list_d"] = [array]
+        user_variables["view_e"] = array[2:5]
+        variables_names.extend(["list_d", "view_e"])
+        loaded_variables = transfer()
+        self.assertNotIn("array_c.1", os.listdir(cache_dir))
+        self.assertIs(
+            loaded_variables["list_d"][0], loaded_variables["array_c"]
+        )
+        array[3] = -1
+        del user_variables["list_d"]
+        variables_names.remove("list_d")
+        loaded_variables = transfer()
+        self.assertEqual(loaded_variables["view_e"][1], -1)
+        self.assertEqual(loaded_variables["array_c"][3], -1)
+
+        # Shape and dtype changed in place, content is the same
+        matrix = numpy.arange(6)
+        user_variables["matrix_f"] = matrix
+        variables_names.append("matrix_f")
+        transfer()
+        self.assertIn("matrix_f.0", os.listdir(cache_dir))
+        matrix.shape = (2, 3)
+        loaded_variables = transfer()
+        self.assertEqual(loaded_variables["matrix_f"].shape, (2, 3))
+        matrix.dtype = numpy.dtype(
+            f"{matrix.dtype.byteorder}u{matrix.dtype.itemsize}"
+        )
+        loaded_variables = transfer()
+        self.assertEqual(loaded_variables["matrix_f"].dtype, matrix.dtype)
+
+    def test_05_extract_read_names(self):
+        code = (
+            "def g(x, y=default_y):\n"
+            "    z = x + y\n"
+            "    return z * scale\n"
+            "class A:\n"
+            "    k = 1\n"
+            "    def m(self):\n"
+            "        return k\n"
+            "res = [i * factor for i in data if i > threshold]\n"
+            "total += 1\n"
+        )
+        self.assertEqual(
+            extract_read_names(code),
+            {
+                "default_y",
+                "scale",
+                "k",
+                "factor",
+                "data",
+                "threshold",
+                "total",
+            },
+        )
+        # Class body reads the global before binding its own x
+        self.assertEqual(
+            extract_read_names("class B:\n    x = x\n    y = 1\n"), {"x"}
+        )
+        self.assertIsNone(extract_read_names("x = eval('y')"))
+        self.assertIsNone(extract_read_names("print(globals()['y'])"))
+
+    def test_06_resolve_read_variables(self):
+        notebook_globals = {"__name__": "__main__"}
+        exec(
+            "config = 1\n"
+            "other = 2\n"
+            "unused = [1, 2, 3]\n"
+            "def helper():\n"
+            "    return config\n"
+            "class Model:\n"
+            "    def run(self):\n"
+            "        return helper() + other\n"
+            "model = Model()\n"
+            "callbacks = [helper]\n"
+            "def dynamic():\n"
+            "    return globals()\n",
+            notebook_globals,
+        )
+        variables_names = ["config", "other", "unused", "model", "callbacks"]
+        self.assertEqual(
+            resolve_read_variables(
+                {"model"}, variables_names, notebook_globals
+            ),
+            ["config", "other", "model"],
+        )
+        self.assertEqual(
+            resolve_read_variables(
+                {"callbacks"}, variables_names, notebook_globals
+            ),
+            ["config", "callbacks"],
+        )
+        self.assertEqual(
+            resolve_read_variables(
+                {"dynamic"}, variables_names, notebook_globals
+            ),
+            variables_names,
+        )
+        self.assertEqual(
+            resolve_read_variables(None, variables_names, notebook_globals),
+            variables_names,
+        )
+
+    def test_07_dump_load_variables_shm_marshall(self):
+        var_file = self.handle_communication("var", "disk", "open")[0]
+        user_variables = {
+            "array_a": numpy.arange(1024 * 1024),
+            "list_b": [1, 2, 3],
+        }
+        dump_variables(
+            list(user_variables.keys()), user_variables, var_file, shm_marshall
+        )
+        # Only the array is large enough to be moved to shared memory
+        segments = [
+            path
+            for path in os.listdir(shm_marshall.shm_marshall.shm_dir)
+            if path.startswith("var_disk_")
+        ]
+        self.assertEqual(len(segments), 1)
+
+        loaded_variables = {}
+        load_variables(loaded_variables, var_file, shm_marshall)
+        numpy.testing.assert_array_equal(
+            loaded_variables["array_a"], user_variables["array_a"]
+        )
+        self.assertEqual(loaded_variables["list_b"], [1, 2, 3])
+        self.assertNotIn(
+            segments[0], os.listdir(shm_marshall.shm_marshall.shm_dir)
+        )
+        self.handle_communication("var", "disk", "close")
+
+    def test_08_dump_load_variables_parallel_marshall(self):
+        var_file = self.handle_communication("var", "memory", "open")[0]
+        user_variables = {f"var_{i}": list(range(i * 1000)) for i in range(8)}
+
+        def transfer():
+            # Writers block until the loader opens their pipes
+            writer = threading.Thread(
+                target=dump_variables,
+                args=(
+                    list(user_variables.keys()),
+                    user_variables,
+                    var_file,
+                    parallel_marshall,
+                ),
+            )
+            writer.start()
+            loaded_variables = {}
+            load_variables(loaded_variables, var_file, parallel_marshall)
+            writer.join()
+            return loaded_variables
+
+        def channels():
+            return sorted(
+                path
+                for path in os.listdir(tmp_dir)
+                if path.startswith("scorep_jupyter_parallel_marshall_")
+            )
+
+        with unittest.mock.patch.multiple(
+            parallel_marshall.parallel_marshall, workers=4, adaptive=0
+        ):
+            self.assertEqual(transfer(), user_variables)
+            session_channels = channels()
+            self.assertEqual(len(session_channels), 4)
+            # Pipes of the parts are reused by the next dump
+            self.assertEqual(transfer(), user_variables)
+            self.assertEqual(channels(), session_channels)
+            parallel_marshall.parallel_marshall.shutdown()
+            self.assertFalse(channels())
+        self.handle_communication("var", "memory", "close")
+
+    def test_09_balanced_distribution(self):
+        array = numpy.zeros(100 * 1024)
+        obj = {
+            # View doesn't own its data, shallow size doesn't include it
+            "array_view": array[1:],
+            "nested": {"inner": [list(range(100)) for _ in range(100)]},
+            "small_a": [1, 2, 3],
+            "small_b": "text",
+        }
+        self.assertGreater(deep_size(obj["array_view"]), array.nbytes // 2)
+        self.assertGreater(
+            serialized_size(obj["nested"], dill),
+            serialized_size(obj["small_a"], dill),
+        )
+        bins = list(BalancedDistributionIterator(obj, 2))
+        self.assertIn(["array_view"], [list(subdict) for subdict in bins])
+        self.assertEqual(
+            sorted(key for subdict in bins for key in subdict),
+            sorted(obj.keys()),
+        )
+
+    def test_10_balanced_distribution_chunks(self):
+        obj = {
+            "array": numpy.arange(4 * 1024 * 1024),
+            "data": bytes(4 * 1024 * 1024),
+            "small": [1, 2, 3],
+        }
+        bins = list(BalancedDistributionIterator(obj, 4))
+        # Values larger than a fair share of a bin are split between bins
+        for subdict in bins:
+            self.assertIn(
+                "array",
+                [key.key for key in subdict if isinstance(key, ChunkKey)],
+            )
+        self.assertIn("data", [key for subdict in bins for key in subdict])
+        merged = merge_bins(bins)
+        numpy.testing.assert_array_equal(merged["array"], obj["array"])
+        self.assertEqual(merged["data"], obj["data"])
+        self.assertEqual(merged["small"], obj["small"])
+
+        obj_list = [list(range(i * 100)) for i in range(50)]
+        bins = list(BalancedDistributionIterator(obj_list, 4))
+        self.assertEqual(merge_bins(bins, is_list=True), obj_list)
+
+        # Subclasses aren't split, they would be joined as the base type
+        class Items(list):
+            pass
+
+        Point = collections.namedtuple("Point", ["x", "y"])
+        obj = {
+            "items": Items(range(512 * 1024)),
+            "point": Point(bytes(4 * 1024 * 1024), 0),
+            "data": bytes(4 * 1024 * 1024),
+        }
+        bins = list(BalancedDistributionIterator(obj, 4))
+        chunked = [
+            key.key
+            for subdict in bins
+            for key in subdict
+            if isinstance(key, ChunkKey)
+        ]
+        self.assertNotIn("items", chunked)
+        self.assertNotIn("point", chunked)
+        merged = merge_bins(bins)
+        self.assertIs(type(merged["items"]), Items)
+        self.assertIs(type(merged["point"]), Point)
+
+        # Values reachable from other items keep their identity unsplit
+        array = numpy.arange(4 * 1024 * 1024)
+        obj = {
+            "array": array,
+            "holder": {"w": array},
+            "other": numpy.arange(4 * 1024 * 1024),
+        }
+        bins = list(BalancedDistributionIterator(obj, 4, keep_identity=True))
+        chunked = {
+            key.key
+            for subdict in bins
+            for key in subdict
+            if isinstance(key, ChunkKey)
+        }
+        self.assertEqual(chunked, {"other"})
+
+    def test_11_parallel_marshall_adaptive_workers(self):
+        module = parallel_marshall.parallel_marshall
+        with unittest.mock.patch.multiple(
+            module, workers=8, adaptive=1, worker_throughput=None
+        ):
+            self.assertEqual(module.choose_n_parts(1024), 1)
+            self.assertEqual(module.choose_n_parts(1024**4), 8)
+            # Slow workers need less data to pay off their start
+            module.record_throughput(10 * 1024**2, 1, 1.0)
+            self.assertEqual(module.choose_n_parts(4 * 1024**2), 4)
+
+    def test_12_parallel_marshall_shared_references(self):
+        var_file = self.handle_communication("var", "disk", "open")[0]
+        shared = [list(range(1000)) for _ in range(4)]
+        user_variables = {f"var_{i}": [shared, i] for i in range(8)}
+        user_variables["alias"] = shared[0]
+
+        with unittest.mock.patch.multiple(
+            parallel_marshall.parallel_marshall, workers=4, adaptive=0
+        ):
+            dump_variables(
+                list(user_variables.keys()),
+                user_variables,
+                var_file,
+                parallel_marshall,
+            )
+            loaded_variables = {}
+            load_variables(loaded_variables, var_file, parallel_marshall)
+
+        self.assertEqual(loaded_variables, user_variables)
+        # Objects referenced from several parts keep their identity
+        loaded_shared = loaded_variables["var_0"][0]
+        for i in range(8):
+            self.assertIs(loaded_variables[f"var_{i}"][0], loaded_shared)
+        self.assertIs(loaded_variables["alias"], loaded_shared[0])
+        self.assertFalse(
+            [
+                path
+                for path in os.listdir(tmp_dir)
+                if path.startswith("var_disk_")
+            ]
+        )
+        self.handle_communication("var", "disk", "close")
+
+        # Values large enough to be split stay shared
+        var_file = self.handle_communication("var", "disk", "open")[0]
+        array = numpy.arange(4 * 1024 * 1024)
+        items = list(range(512 * 1024))
+        user_variables = {
+            "array": array,
+            "holder": {"w": array},
+            "items": items,
+            "items_holder": [items],
+        }
+        with unittest.mock.patch.multiple(
+            parallel_marshall.parallel_marshall, workers=4, adaptive=0
+        ):
+            dump_variables(
+                list(user_variables.keys()),
+                user_variables,
+                var_file,
+                parallel_marshall,
+            )
+            loaded_variables = {}
+            load_variables(loaded_variables, var_file, parallel_marshall)
+        self.assertIs(
+            loaded_variables["array"], loaded_variables["holder"]["w"]
+        )
+        self.assertIs(
+            loaded_variables["items"], loaded_variables["items_holder"][0]
+        )
+        numpy.testing.assert_array_equal(loaded_variables["array"], array)
+        self.assertEqual(loaded_variables["items"], items)
+        self.handle_communication("var", "disk", "close")
+
+    def test_13_parallel_marshall_writer_threads(self):
+        var_file = self.handle_communication("var", "memory", "open")[0]
+        array = numpy.arange(4 * 1024 * 1024)
+        user_variables = {
+            "array_a": array,
+            "view_b": array[::2],
+            "list_c": [list(range(1000)) for _ in range(10)],
+        }
+        writer = threading.Thread(
+            target=dump_variables,
+            args=(
+                list(user_variables.keys()),
+                user_variables,
+                var_file,
+                parallel_marshall,
+            ),
+        )
+        with unittest.mock.patch.multiple(
+            parallel_marshall.parallel_marshall,
+            workers=4,
+            adaptive=0,
+            writer_backend="thread",
+        ):
+            processes = multiprocessing.active_children()
+            writer.start()
+            loaded_variables = {}
+            load_variables(loaded_variables, var_file, parallel_marshall)
+            writer.join()
+            # Parts are written without forking the dumping process
+            self.assertEqual(multiprocessing.active_children(), processes)
+            parallel_marshall.parallel_marshall.shutdown()
+
+        numpy.testing.assert_array_equal(loaded_variables["array_a"], array)
+        numpy.testing.assert_array_equal(
+            loaded_variables["view_b"], array[::2]
+        )
+        self.assertEqual(loaded_variables["list_c"], user_variables["list_c"])
+        self.handle_communication("var", "memory", "close")
+
+    def test_14_dump_load_variables_stream(self):
+        var_file = self.handle_communication("var", "memory", "open")[0]
+        user_variables = {
+            "array_a": numpy.arange(1024 * 1024),
+            "list_b": [1, 2, 3],
+            "text_c": "text",
+        }
+        loaded_variables = {}
+
+        def load():
+            load_variables_stream(loaded_variables, var_file, dill)
+
+        # Variables are loaded one by one while the next one is dumped
+        loader = threading.Thread(target=load)
+        loader.start()
+        dump_variables_stream(
+            list(user_variables.keys()), user_variables, var_file, dill
+        )
+        loader.join()
+        self.assertEqual(list(loaded_variables), list(user_variables))
+        numpy.testing.assert_array_equal(
+            loaded_variables["array_a"], user_variables["array_a"]
+        )
+        self.assertEqual(loaded_variables["list_b"], [1, 2, 3])
+        self.assertEqual(loaded_variables["text_c"], "text")
+        self.handle_communication("var", "memory", "close")
+
+        # Objects shared between variables stay shared
+        var_file = self.handle_communication("var", "disk", "open")[0]
+        shared = [1, 2]
+        for marshaller in (dill, cloudpickle):
+            loaded_variables = {}
+            dump_variables_stream(
+                ["a", "b"], {"a": shared, "b": shared}, var_file, marshaller
+            )
+            load_variables_stream(loaded_variables, var_file, marshaller)
+            self.assertIs(loaded_variables["a"], loaded_variables["b"])
+        self.handle_communication("var", "disk", "close")
+
+        var_file = self.handle_communication("var", "disk", "open")[0]
+        dump_variables_stream(["list_b"], user_variables, var_file, dill)
+        with open(var_file, "r+b") as file:
+            file.truncate(os.path.getsize(var_file) - 1)
+        with self.assertRaises(EOFError):
+            load_variables_stream({}, var_file, dill)
+        self.handle_communication("var", "disk", "close")
+
+        # Records are serialized independently
+        var_file = self.handle_communication("var", "disk", "open")[0]
+        dump_variables_records(
+            list(user_variables.keys()), user_variables, var_file, dill
+        )
+        loaded_variables = {}
+        load_variables_records(loaded_variables, var_file, dill)
+        self.assertEqual(loaded_variables["list_b"], [1, 2, 3])
+        with open(var_file, "r+b") as file:
+            file.truncate(os.path.getsize(var_file) - 1)
+        with self.assertRaises(EOFError):
+            load_variables_records({}, var_file, dill)
+        self.handle_communication("var", "disk", "close")
+
+    def test_15_load_variables_lazy(self):
+        var_file = self.handle_communication("var", "disk", "open")[0]
+        user_variables = {
+            "array_a": numpy.arange(10),
+            "list_b": [1, 2],
+            "list_c": [3],
+            "helper": 0,
+        }
+        dump_variables_records(
+            list(user_variables.keys()), user_variables, var_file, dill
+        )
+        notebook_globals = {"__name__": "__main__"}
+        load_variables_lazy(notebook_globals, var_file, dill)
+        for name in user_variables:
+            self.assertIsInstance(notebook_globals[name], LazyVariable)
+
+        with unittest.mock.patch.dict(
+            os.environ, {"SCOREP_JUPYTER_PERSISTENCE_DIR": tmp_dir}
+        ):
+            pershelper = PersHelper()
+        pershelper.lazy_variables.update(user_variables)
+        # Only variables read by the cell are deserialized
+        pershelper.materialize("x = array_a + 1", notebook_globals)
+        numpy.testing.assert_array_equal(
+            notebook_globals["array_a"], user_variables["array_a"]
+        )
+        self.assertIsInstance(notebook_globals["list_b"], LazyVariable)
+
+        # Including variables read by notebook functions, rebound
+        # placeholders are dropped
+        exec("def helper():\n    return list_b\n", notebook_globals)
+        pershelper.materialize("helper()", notebook_globals)
+        self.assertEqual(notebook_globals["list_b"], [1, 2])
+        self.assertEqual(pershelper.lazy_variables, {"list_c"})
+
+        pershelper.materialize("%whos", notebook_globals)
+        self.assertEqual(notebook_globals["list_c"], [3])
+        self.assertFalse(pershelper.lazy_variables)
+
+        # Incomplete code, e.g. completion or inspection requests
+        load_variables_lazy(notebook_globals, var_file, dill)
+        pershelper.lazy_variables.update(["list_b", "list_c"])
+        pershelper.materialize_identifiers("list_b.app", notebook_globals)
+        self.assertEqual(notebook_globals["list_b"], [1, 2])
+        self.assertIsInstance(notebook_globals["list_c"], LazyVariable)
+        self.handle_communication("var", "disk", "close")
+
+    def test_16_subprocess_lazy_faulting(self):
+        with unittest.mock.patch.dict(
+            os.environ,
+            {
+                "SCOREP_JUPYTER_PERSISTENCE_DIR": tmp_dir,
+                "SCOREP_JUPYTER_STREAMING_TRANSFER": "1",
+                "SCOREP_JUPYTER_LAZY_FAULTING": "1",
+                # Script runs without Score-P here
+                "SCOREP_JUPYTER_TRACE_PERSISTENCE": "1",
+                "SCOREP_JUPYTER_PHASE_REGIONS": "0",
+            },
+        ):
+            pershelper = PersHelper("dill", "disk")
+            pershelper.set_transfer_settings()
+        for key1 in pershelper.paths:
+            for key2 in pershelper.paths[key1]:
+                path = f"{tmp_dir}{key1}_{key2}"
+                open(path, "a").close()
+                pershelper.paths[key1][key2] = path
+        pershelper.jupyter_definitions = (
+            "def total():\n"
+            "    return sum(b)\n"
+            "def pending():\n"
+            "    return sorted(globals().records)\n"
+        )
+        notebook_variables = {"a": 1, "b": [1, 2, 3], "other": [4]}
+        dump_runtime(
+            {},
+            [],
+            pershelper.paths["jupyter"]["os_environ"],
+            pershelper.paths["jupyter"]["sys_path"],
+            dill,
+        )
+        dump_variables_records(
+            list(notebook_variables.keys()),
+            notebook_variables,
+            pershelper.paths["jupyter"]["var"],
+            dill,
+        )
+
+        # Namespace would have to be read dynamically, variables are loaded
+        # eagerly then
+        self.assertNotIn(
+            "namespace_",
+            pershelper.subprocess_wrapper("c = globals()['a']"),
+        )
+        subprocess_code = pershelper.subprocess_wrapper(
+            "before = pending()\nc = a + total()\nafter = pending()\n"
+        )
+        script_path = tmp_dir + scorep_script_name
+        with open(script_path, "w") as file:
+            file.write(subprocess_code)
+        env = dict(os.environ, PYTHONPATH="src")
+        proc = subprocess.run([PYTHON_EXECUTABLE, script_path], env=env)
+        self.assertFalse(proc.returncode)
+
+        loaded_variables = {}
+        load_variables_stream(
+            loaded_variables, pershelper.paths["subprocess"]["var"], dill
+        )
+        # Variables are deserialized when the code looks them up
+        self.assertEqual(loaded_variables["before"], ["a", "b", "other"])
+        self.assertEqual(loaded_variables["after"], ["other"])
+        self.assertEqual(loaded_variables["c"], 7)
+
+    def test_17_subprocess_persistence_not_instrumented(self):
+        with unittest.mock.patch.dict(
+            os.environ,
+            {
+                "SCOREP_JUPYTER_PERSISTENCE_DIR": tmp_dir,
+                "SCOREP_JUPYTER_PHASE_REGIONS": "1",
+            },
+        ):
+            pershelper = PersHelper("dill", "disk")
+            pershelper.set_transfer_settings()
+        pershelper.jupyter_definitions = "def f():\n    return a\n"
+        code = "b = f()\n"
+        subprocess_code = pershelper.subprocess_wrapper(code, "cell_3")
+        compile(subprocess_code, scorep_script_name, "exec")
+        # Persistence calls run with the instrumenter disabled in regions
+        # of their phases, the cell code and notebook definitions don't
+        root = ast.parse(subprocess_code)
+        disabled_calls = {}
+        for node in root.body:
+            if isinstance(node, ast.With):
+                context = node.items[0].context_expr
+                self.assertEqual(
+                    ast.unparse(context.func), "scorep.instrumenter.disable"
+                )
+                disabled_calls[context.args[0].value] = [
+                    ast.unparse(statement.value.func)
+                    for statement in node.body
+                ]
+        self.assertEqual(
+            disabled_calls,
+            {
+                "scorep_jupyter:load_runtime": ["load_runtime"],
+                "scorep_jupyter:load_variables": ["load_variables"],
+                "scorep_jupyter:dump": ["dump_runtime", "dump_variables"],
+            },
+        )
+        self.assertIn("\ndef f():\n    return a\n", subprocess_code)
+        self.assertIn(
+            "scorep.user.region_begin('scorep_jupyter:cell_3')\ntry:\n",
+            subprocess_code,
+        )
+        # Cell region is ended even if the cell raises, the cell code is
+        # compiled as is
+        cell_try = next(
+            node for node in root.body if isinstance(node, ast.Try)
+        )
+        self.assertEqual(
+            ast.unparse(cell_try.finalbody[0]),
+            "scorep.user.region_end('scorep_jupyter:cell_3')",
+        )
+        self.assertEqual(
+            ast.unparse(cell_try.body[0]),
+            f"exec(compile({code + chr(10)!r}, __file__, 'exec'), globals())",
+        )
+
+        with unittest.mock.patch.dict(
+            os.environ,
+            {
+                "SCOREP_JUPYTER_TRACE_PERSISTENCE": "1",
+                "SCOREP_JUPYTER_PHASE_REGIONS": "0",
+            },
+        ):
+            pershelper.set_transfer_settings()
+        subprocess_code = pershelper.subprocess_wrapper(code)
+        self.assertNotIn("scorep.", subprocess_code)
+
+    def test_18_phase_report(self):
+        with unittest.mock.patch.dict(
+            os.environ,
+            {
+                "SCOREP_JUPYTER_PERSISTENCE_DIR": tmp_dir,
+                "SCOREP_JUPYTER_PHASE_REPORT": "json",
+                "SCOREP_JUPYTER_STREAMING_TRANSFER": "1",
+                # Script runs without Score-P here
+                "SCOREP_JUPYTER_TRACE_PERSISTENCE": "1",
+                "SCOREP_JUPYTER_PHASE_REGIONS": "0",
+            },
+        ):
+            pershelper = PersHelper("dill", "disk")
+            pershelper.set_dump_report_level()
+            pershelper.set_transfer_settings()
+        for key1 in pershelper.paths:
+            for key2 in pershelper.paths[key1]:
+                path = f"{tmp_dir}report_{key1}_{key2}"
+                open(path, "a").close()
+                pershelper.paths[key1][key2] = path
+
+        pershelper.jupyter_variables = ["a"]
+        report = PhaseReport()
+        report.start_ghost_cell()
+        # Ghost cell counts bytes returned by dumps
+        exec(
+            "from scorep_jupyter.phase_report import record_transfer\n"
+            + "record_transfer("
+            + pershelper.dump_variables_call()
+            + ")\n"
+            + "record_transfer(dump_runtime({}, [], "
+            + f"'{pershelper.paths['jupyter']['os_environ']}', "
+            + f"'{pershelper.paths['jupyter']['sys_path']}', dill))\n",
+            {
+                "dump_variables_stream": dump_variables_stream,
+                "dump_runtime": dump_runtime,
+                "dill": dill,
+                "a": list(range(1000)),
+            },
+        )
+        report.stop_ghost_cell("jupyter_dump", "Jupyter -> Score-P")
+
+        script_path = tmp_dir + scorep_script_name
+        with open(script_path, "w") as file:
+            file.write(pershelper.subprocess_wrapper("b = a[:10]\n"))
+        launch_time = time.time()
+        env = dict(os.environ, PYTHONPATH="src")
+        proc = subprocess.run([PYTHON_EXECUTABLE, script_path], env=env)
+        self.assertFalse(proc.returncode)
+        report.add_subprocess_report(launch_time, "Score-P -> Jupyter")
+        os.remove(phase_report_name)
+
+        report_json = json.loads(report.to_json())
+        self.assertEqual(
+            list(report_json["phases"]),
+            [
+                "jupyter_dump",
+                "startup",
+                "load_runtime",
+                "load_variables",
+                "cell",
+                "dump",
+            ],
+        )
+        self.assertGreater(report_json["bytes"]["Jupyter -> Score-P"], 1000)
+        self.assertGreater(report_json["bytes"]["Score-P -> Jupyter"], 0)
+        self.assertIn("load_variables", report.to_text())
+
+    def test_19_kernel_timeline(self):
+        timeline = KernelTimeline()
+        # Spans aren't recorded before the timeline is opened
+        with timeline.span("ignored"):
+            pass
+        timeline.open(tmp_dir + "timeline")
+        with timeline.span("do_execute", execution_count=1):
+            report = PhaseReport(timeline)
+            report.start()
+            report.stop("preprocess")
+            reader = threading.Thread(
+                target=lambda: timeline.end(timeline.begin("read_stderr")),
+                name="scorep_stderr_reader",
+            )
+            reader.start()
+            reader.join()
+        timeline.close()
+
+        # Closing bracket of the array is left out by the kernel
+        with open(timeline.path, "r") as file:
+            events = json.loads(file.read().rstrip().rstrip(",") + "]")
+        spans = {
+            event["name"]: event for event in events if event["ph"] == "X"
+        }
+        self.assertEqual(
+            set(spans), {"do_execute", "preprocess", "read_stderr"}
+        )
+        self.assertEqual(spans["do_execute"]["args"], {"execution_count": 1})
+        self.assertLessEqual(
+            spans["do_execute"]["ts"], spans["preprocess"]["ts"]
+        )
+        self.assertNotEqual(
+            spans["read_stderr"]["tid"], spans["do_execute"]["tid"]
+        )
+        thread_names = {
+            event["tid"]: event["args"]["name"]
+            for event in events
+            if event["name"] == "thread_name"
+        }
+        self.assertEqual(
+            thread_names[spans["read_stderr"]["tid"]], "scorep_stderr_reader"
+        )
+
+    def test_20_persistence_placement(self):
+        ram_dir = tmp_dir + "placement_ram"
+        os.makedirs(ram_dir, exist_ok=True)
+        with unittest.mock.patch.dict(
+            os.environ, {"SCOREP_JUPYTER_PERSISTENCE_DIR": tmp_dir}
+        ):
+            pershelper = PersHelper("dill", "disk")
+            pershelper.set_transfer_settings()
+            pershelper.jupyter_variables = ["a"]
+            globals_ = {"a": list(range(1000))}
+            with unittest.mock.patch(
+                "src.scorep_jupyter.userpersistence.persistence_candidates",
+                return_value=[ram_dir],
+            ):
+                self.assertEqual(
+                    pershelper.place_persistence(globals_), ram_dir
+                )
+                self.assertTrue(pershelper.preprocess())
+                self.assertTrue(
+                    pershelper.paths["jupyter"]["var"].startswith(ram_dir)
+                )
+                pershelper.postprocess()
+                self.assertEqual(os.listdir(ram_dir), [])
+
+                # Payload not fitting into the free space
+                with unittest.mock.patch(
+                    "src.scorep_jupyter.userpersistence"
+                    ".placement_space_factor",
+                    float("inf"),
+                ):
+                    self.assertEqual(
+                        pershelper.place_persistence(globals_), tmp_dir
+                    )
+                with unittest.mock.patch.dict(
+                    os.environ,
+                    {"SCOREP_JUPYTER_PERSISTENCE_PLACEMENT": "configured"},
+                ):
+                    pershelper.set_transfer_settings()
+                    self.assertEqual(
+                        pershelper.place_persistence(globals_), tmp_dir
+                    )
+
+                # Size of the previous dump is used instead of estimating it
+                pershelper.set_transfer_settings()
+                with unittest.mock.patch(
+                    "parallel_marshall.size_estimators.deep_size",
+                    side_effect=AssertionError,
+                ):
+                    pershelper.transfer_size = 1000
+                    self.assertEqual(
+                        pershelper.place_persistence(globals_), ram_dir
+                    )
+                    pershelper.transfer_size = free_space(ram_dir)
+                    self.assertEqual(
+                        pershelper.place_persistence(globals_), tmp_dir
+                    )
+
+    def test_21_preload_environment(self):
+        computed = []
+        subsystem_dir = tmp_dir + "subsystem"
+        os.makedirs(subsystem_dir, exist_ok=True)
+
+        def binding_subsystem(scorep_binding_args):
+            computed.append(scorep_binding_args)
+            return subsystem_dir, " ".join(scorep_binding_args)
+
+        installation = [(("scorep-config", 1),)]
+        environment = PreloadEnvironment()
+        with unittest.mock.patch(
+            "scorep_jupyter.bindings.binding_subsystem",
+            side_effect=binding_subsystem,
+        ), unittest.mock.patch(
+            "scorep_jupyter.bindings.scorep_installation_id",
+            side_effect=lambda: installation[0],
+        ), unittest.mock.patch.dict(
+            os.environ, {"LD_PRELOAD": "", "LD_LIBRARY_PATH": ""}
+        ):
+            environ = environment.get(["--mpp=none"])
+            self.assertEqual(environment.get(["--mpp=none"]), environ)
+            self.assertEqual(len(computed), 1)
+            self.assertEqual(environ["LD_PRELOAD"], "--mpp=none")
+            self.assertEqual(environ["LD_LIBRARY_PATH"], subsystem_dir)
+
+            # Changes of the kernel environment are followed
+            os.environ["LD_PRELOAD"] = "libuser.so"
+            os.environ["LD_LIBRARY_PATH"] = "/opt/lib"
+            environ = environment.get(["--mpp=none"])
+            self.assertEqual(len(computed), 1)
+            self.assertEqual(environ["LD_PRELOAD"], "--mpp=none libuser.so")
+            self.assertEqual(environ["SCOREP_LD_PRELOAD_BACKUP"], "libuser.so")
+            self.assertEqual(
+                environ["LD_LIBRARY_PATH"], f"{subsystem_dir}:/opt/lib"
+            )
+
+            # Changed arguments or installation recompute it
+            environment.get(["--mpp=mpi"])
+            self.assertEqual(len(computed), 2)
+            installation[0] = (("scorep-config", 2),)
+            environment.get(["--mpp=mpi"])
+            self.assertEqual(len(computed), 3)
+            # Subsystem evicted from the cache is looked up again
+            os.rmdir(subsystem_dir)
+            environment.get(["--mpp=mpi"])
+            self.assertEqual(len(computed), 4)
+
+    def test_22_subsystem_cache(self):
+        cache_dir = tmp_dir + "subsystem_cache"
+        installation = (("scorep-config", 1),)
+        with unittest.mock.patch.dict(
+            os.environ,
+            {
+                "SCOREP_JUPYTER_SUBSYSTEM_CACHE_DIR": cache_dir,
+                "LD_PRELOAD": "libuser.so",
+                "LD_LIBRARY_PATH": "/usr/lib",
+            },
+        ), unittest.mock.patch(
+            "scorep_jupyter.bindings.scorep_installation_id",
+            return_value=installation,
+        ):
+            # Library generated by an earlier run with the same configuration
+            key = hashlib.sha256(
+                json.dumps([["--mpp=none"], installation]).encode()
+            ).hexdigest()
+            subsystem_dir = os.path.join(cache_dir, key)
+            os.makedirs(subsystem_dir)
+            with open(
+                os.path.join(subsystem_dir, subsystem_preload_name), "w"
+            ) as file:
+                file.write("libscorep.so libscorep_init_subsystem.so")
+
+            environ = subsystem_environment(["--mpp=none"])
+        self.assertEqual(
+            environ["LD_PRELOAD"],
+            "libscorep.so libscorep_init_subsystem.so libuser.so",
+        )
+        self.assertEqual(environ["SCOREP_LD_PRELOAD_BACKUP"], "libuser.so")
+        self.assertEqual(
+            environ["SCOREP_PYTHON_BINDINGS_TEMP_DIR"], subsystem_dir
+        )
+        self.assertEqual(
+            environ["LD_LIBRARY_PATH"], f"{subsystem_dir}:/usr/lib"
+        )
+
+        # Least recently used libraries are evicted, the one just used is
+        # kept, staging directories of libraries being generated as well
+        old_keys = [
+            hashlib.sha256(str(i).encode()).hexdigest() for i in range(3)
+        ]
+        for i, old_key in enumerate(old_keys):
+            os.makedirs(os.path.join(cache_dir, old_key))
+            os.utime(os.path.join(cache_dir, old_key), (i, i))
+        os.makedirs(os.path.join(cache_dir, "tmpstaging"))
+        evict_subsystems(cache_dir, 2)
+        self.assertEqual(
+            sorted(os.listdir(cache_dir)),
+            sorted([key, old_keys[2], "tmpstaging"]),
+        )
+
+    def test_23_standby_process(self):
+        self.assertEqual(
+            extract_imported_modules(
+                "import numpy as np, os.path\n"
+                "from collections import abc\n"
+                "from . import local\n"
+            ),
+            ["numpy", "os.path", "collections"],
+        )
+        with unittest.mock.patch.dict(
+            os.environ, {"SCOREP_JUPYTER_PERSISTENCE_DIR": tmp_dir}
+        ):
+            pershelper = PersHelper("dill", "disk")
+        pershelper.jupyter_definitions = "import numpy\n"
+        standby_code = pershelper.standby_wrapper("scorep_standby_test")
+        ast.parse(standby_code)
+        self.assertIn("['dill', 'numpy']", standby_code)
+
+        # Same protocol as the standby wrapper, without Score-P
+        standby_code = (
+            "import os, sys\n"
+            "os.remove(__file__)\n"
+            "script_path_ = sys.stdin.readline().strip()\n"
+            "if script_path_:\n"
+            "    exec(open(script_path_).read(), {'__name__': '__main__'})\n"
+        )
+        script_path = tmp_dir + "standby_cell.py"
+        with open(script_path, "w") as file:
+            file.write("import os\nprint(os.environ['STANDBY_TEST'])\n")
+        cmd = [PYTHON_EXECUTABLE]
+        proc_env = dict(os.environ, STANDBY_TEST="1")
+        standby = StandbyProcess()
+        standby.spawn(cmd, proc_env, standby_code, "scorep-test")
+
+        # Changed environment doesn't match the standby process
+        self.assertEqual(
+            standby.take(cmd, dict(proc_env, STANDBY_TEST="2")), (None, "")
+        )
+        self.assertIsNone(standby.proc)
+        # Neither does a changed notebook runtime
+        runtime = ({"STANDBY_TEST": "1"}, ["src"])
+        standby.spawn(cmd, proc_env, standby_code, "", runtime)
+        self.assertEqual(
+            standby.take(cmd, proc_env, ({"STANDBY_TEST": "1"}, [])),
+            (None, ""),
+        )
+        standby.spawn(cmd, proc_env, standby_code, "scorep-test")
+        proc, experiment_directory = standby.take(cmd, proc_env)
+        self.assertEqual(experiment_directory, "scorep-test")
+        run_script(proc, script_path)
+        self.assertEqual(proc.stdout.read(), b"1\n")
+        self.assertEqual(proc.wait(), 0)
+        proc.stdout.close()
+        proc.stderr.close()
+        self.assertEqual(glob.glob("scorep_standby_*.py"), [])
+
+        # Notebook modules are imported with the runtime of the notebook,
+        # only found on its sys.path here. Output while waiting doesn't
+        # block the standby process, it's written once the script is
+        # handed over
+        with open(tmp_dir + "noisy_module.py", "w") as file:
+            file.write(
+                "import atexit, os, sys\n"
+                "sys.stdout.write('o' * 200000)\n"
+                "sys.stderr.write('e' * 200000)\n"
+                f"with open({tmp_dir + 'imported'!r}, 'w') as file:\n"
+                "    file.write(os.environ['STANDBY_RUNTIME'])\n"
+                f"atexit.register(open, {tmp_dir + 'finalized'!r}, 'w')\n"
+            )
+        pershelper.jupyter_definitions = "import noisy_module\n"
+
+        def spawn_standby(experiment_directory=""):
+            runtime_prefix = standby_file_prefix()
+            with unittest.mock.patch.dict(
+                os.environ, {"STANDBY_RUNTIME": "1"}
+            ), unittest.mock.patch.object(sys, "path", sys.path + [tmp_dir]):
+                runtime = pershelper.dump_standby_runtime(runtime_prefix)
+            # Score-P replaced by no-ops
+            standby_code = (
+                pershelper.standby_wrapper(runtime_prefix)
+                .replace("import scorep.instrumenter", "import contextlib")
+                .replace("import scorep.user\n", "")
+                .replace("scorep.user.disable_recording()\n", "")
+                .replace("scorep.user.enable_recording()\n", "")
+                .replace(
+                    "scorep.instrumenter.disable()", "contextlib.nullcontext()"
+                )
+            )
+            standby.spawn(
+                cmd, proc_env, standby_code, experiment_directory, runtime
+            )
+            deadline = time.time() + 30
+            while not os.path.exists(tmp_dir + "imported"):
+                self.assertLess(time.time(), deadline)
+                time.sleep(0.05)
+            with open(tmp_dir + "imported") as file:
+                self.assertEqual(file.read(), "1")
+            os.remove(tmp_dir + "imported")
+            self.assertEqual(glob.glob(f"{runtime_prefix}*"), [])
+            return runtime
+
+        proc_env = dict(proc_env, PYTHONPATH="src")
+        runtime = spawn_standby()
+        proc, _ = standby.take(cmd, proc_env, runtime)
+        run_script(proc, script_path)
+        stderr = []
+        reader = threading.Thread(
+            target=lambda: stderr.append(proc.stderr.read())
+        )
+        reader.start()
+        self.assertEqual(proc.stdout.read(), b"o" * 200000 + b"1\n")
+        reader.join()
+        self.assertEqual(stderr, [b"e" * 200000])
+        self.assertEqual(proc.wait(), 0)
+        proc.stdout.close()
+        proc.stderr.close()
+        self.assertTrue(os.path.exists(tmp_dir + "finalized"))
+        os.remove(tmp_dir + "finalized")
+
+        # Stopping doesn't wait for the process, which exits without
+        # finalizing. Its experiment directory is removed.
+        experiment_directory = tmp_dir + "scorep-standby"
+        os.mkdir(experiment_directory)
+        spawn_standby(experiment_directory)
+        proc = standby.proc
+        standby.stop()
+        self.assertIsNone(standby.proc)
+        self.assertEqual(proc.wait(timeout=30), 0)
+        deadline = time.time() + 30
+        while os.path.exists(experiment_directory):
+            self.assertLess(time.time(), deadline)
+            time.sleep(0.05)
+        self.assertFalse(os.path.exists(tmp_dir + "finalized"))
+
+    def test_24_scorep_session(self):
+        # Marker split across reads, output of the next script is kept
+        marker = b"\0marker:"
+        stream = SessionStream(
+            io.BufferedReader(
+                io.BytesIO(b"first\n\0mar" b"ker:0\nsecond\0marker:1\n"),
+                buffer_size=8,
+            ),
+            marker,
+        )
+        for status, output in ((0, b"first\n"), (1, b"second")):
+            stream.start_script()
+            data = b""
+            while stream.status is None:
+                data += stream.read(4)
+            self.assertEqual((stream.status, data), (status, output))
+
+        self.assertEqual(
+            extract_bound_names(
+                "import os.path\nx, y = 1, 2\ndef f():\n    z = 3\n"
+                "class C:\n    pass\n"
+            ),
+            {"os", "x", "y", "f", "z", "C"},
+        )
+        self.assertEqual(
+            extract_bound_names(
+                "c += 1\nfor i, j in p:\n    pass\nwith q as w:\n    pass\n"
+                "print(n := 1)\ndel d\nlst.append(5)\n"
+            ),
+            {"c", "i", "j", "w", "n", "d"},
+        )
+        with unittest.mock.patch.dict(
+            os.environ, {"SCOREP_JUPYTER_PERSISTENCE_DIR": tmp_dir}
+        ):
+            pershelper = PersHelper("dill", "disk")
+        globals_ = {"__name__": "__main__", "a": 1}
+        exec("def g():\n    return b\n", globals_)
+        session_names = {"b"}
+        for code, needs_sync in (
+            ("print(a)", False),
+            ("print(b)", True),
+            ("g()", True),
+            ("a = 2", True),
+            ("%time print(a)", True),
+            ("print(", True),
+            ("counter += 1", True),
+            ("for i in range(3):\n    pass", True),
+            ("with open(path) as f:\n    pass", True),
+            ("print(n := 1)", True),
+            ("del a", True),
+        ):
+            self.assertEqual(
+                pershelper.session_needs_sync(code, session_names, globals_),
+                needs_sync,
+                code,
+            )
+        # Notebook variables loaded by the session might change in place
+        globals_.update(lst=[1], df=unittest.mock.Mock())
+        pershelper.jupyter_variables = ["a", "lst", "df"]
+        for code in ("print(a)", "lst.append(5)", "df.dropna(inplace=True)"):
+            self.assertTrue(
+                pershelper.session_needs_sync(code, session_names, globals_),
+                code,
+            )
+        self.assertFalse(
+            pershelper.session_needs_sync("print(1)", session_names, globals_)
+        )
+
+        # Session wrapper without Score-P, scripts share the namespace
+        session_helper = unittest.mock.Mock()
+        session_helper.session_wrapper = lambda marker: (
+            pershelper.session_wrapper(marker)
+            .replace("import scorep.instrumenter", "import contextlib")
+            .replace(
+                "scorep.instrumenter.disable()", "contextlib.nullcontext()"
+            )
+        )
+        session = ScorepSession(
+            [PYTHON_EXECUTABLE], dict(os.environ), session_helper, ""
+        )
+        outputs = []
+        for code in ("b = 2\nprint(b)\n", "print(b + 1)\n", "1 / 0\n"):
+            script_path = tmp_dir + "session_cell.py"
+            with open(script_path, "w") as file:
+                file.write(code)
+            script = session.run_script(script_path)
+            stdout = b""
+            while script.poll() is None:
+                stdout += script.stdout.read()
+            stderr = b""
+            while script.stderr.status is None:
+                stderr += script.stderr.read()
+            outputs.append((script.wait(), stdout, b"ZeroDivision" in stderr))
+        self.assertEqual(
+            outputs,
+            [(0, b"2\n", False), (0, b"3\n", False), (1, b"", True)],
+        )
+        self.assertTrue(session.is_alive())
+        self.assertEqual(session.close(), 0)
+        self.assertEqual(glob.glob("scorep_standby_*.py"), [])
+
+    def test_25_repetition_report(self):
+        # Repetitions except the final one report the cell without dump
+        launch_time = time.time()
+        cell_times = []
+        for cell_time in (1.5, 0.5, 1.0):
+            write_subprocess_report(
+                [
+                    ("startup", launch_time + 0.25),
+                    ("cell", launch_time + 0.25 + cell_time),
+                ],
+                0,
+            )
+            report = PhaseReport()
+            report.add_subprocess_report(launch_time, "Score-P -> Jupyter")
+            self.assertNotIn("dump", report.durations)
+            self.assertAlmostEqual(report.durations["startup"], 0.25)
+            cell_times.append(report.durations["cell"])
+        os.remove(phase_report_name)
+        self.assertAlmostEqual(min(cell_times), 0.5)
+        self.assertAlmostEqual(statistics.median(cell_times), 1.0)
+        self.assertAlmostEqual(max(cell_times), 1.5)
+
+    def test_26_repetitions(self):
+        for magic_line, repetitions in (
+            ("%%execute_with_scorep", None),
+            ("%%execute_with_scorep --repeat 3", 3),
+            ("%%execute_with_scorep --repeat=12", 12),
+        ):
+            self.assertEqual(parse_repetitions(magic_line), repetitions)
+        for magic_line in (
+            "%%execute_with_scorep --repeat",
+            "%%execute_with_scorep --repeat 0",
+            "%%execute_with_scorep --repeat abc",
+            "%%execute_with_scorep --repeat=-2",
+            "%%execute_with_scorep --repeat 2x",
+        ):
+            with self.assertRaises(ValueError, msg=magic_line):
+                parse_repetitions(magic_line)
+
+        # Assigned directories, only the final repetition dumps
+        names = iter(("scorep-a", "scorep-b", "scorep-c"))
+        self.assertEqual(
+            list(repetition_runs(3, None, lambda: next(names))),
+            [
+                (1, "scorep-a", False),
+                (2, "scorep-b", False),
+                (3, "scorep-c", True),
+            ],
+        )
+        # Directory set by the user is numbered per repetition
+        self.assertEqual(
+            list(repetition_runs(2, "profile", lambda: "")),
+            [(1, "profile_1", False), (2, "profile_2", True)],
+        )
+
+    def test_27_forked_process(self):
+        # Exit status and output of the child are reported to the kernel
+        for exit_code in (0, 3):
+            stdout_read, stdout_write = os.pipe()
+            pid = os.fork()
+            if pid == 0:
+                os.write(stdout_write, b"child\n")
+                os._exit(exit_code)
+            os.close(stdout_write)
+            proc = ForkedProcess(pid, os.fdopen(stdout_read, "rb"), None)
+            self.assertEqual(proc.stdout.read(), b"child\n")
+            self.assertEqual(proc.wait(), exit_code)
+            self.assertEqual(proc.poll(), exit_code)
+            proc.stdout.close()
+
+        pid = os.fork()
+        if pid == 0:
+            time.sleep(30)
+            os._exit(0)
+        proc = ForkedProcess(pid, None, None)
+        self.assertIsNone(proc.poll())
+        os.kill(pid, signal.SIGTERM)
+        self.assertEqual(proc.wait(), -signal.SIGTERM)
+
 
 if __name__ == "__main__":
     unittest.main()